@@ -0,0 +1,363 @@
+"""
+Times the document parser and the loader on the sample articles and schemas,
+and on copies of the articles scaled to more TUAs, and writes the results as
+a JSON report. Reports from two commits can be compared with -c, which exits
+with an error when a benchmark got slower by more than the threshold.
+
+The loader benchmarks run against a throwaway SQLite database unless another
+database is given with --database-url.
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ARTICLE_DIR = os.path.join(BASE_DIR, 'data', 'sample', 'article')
+SCHEMA_DIR = os.path.join(BASE_DIR, 'data', 'sample', 'schema')
+
+# How many more TUAs the scaled articles have
+SCALES = (1, 10, 100)
+
+# Times each article and schema is parsed. The fastest time is kept, which
+# leaves out most of the noise of other processes.
+REPEAT = 3
+
+# Slowdown, as a fraction of the baseline, that counts as a regression
+THRESHOLD = 0.2
+
+# The header of an article: the +*+* line and the two lines after it
+HEADER_RE = re.compile(r'\A(.*?\+\*\+\*[^\n]*\n(?:[ \t\r]*\n)*[^\n]*\n'
+                       r'(?:[ \t\r]*\n)*[^\n]*\n)', re.S)
+
+def stats(times, **extra):
+    """
+    Summarizes a list of per-call times in seconds.
+    """
+    times = sorted(times)
+    result = dict(extra)
+    result['count'] = len(times)
+    result['total_seconds'] = sum(times)
+    if times:
+        result['mean_seconds'] = sum(times) / len(times)
+        result['p50_seconds'] = percentile(times, 50)
+        result['p95_seconds'] = percentile(times, 95)
+        result['max_seconds'] = times[-1]
+    return result
+
+def fastest(repeat, func, *args):
+    """
+    Returns the result of func(*args) and the fastest time of repeat calls.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        result = func(*args)
+        seconds = time.time() - start
+        best = seconds if best is None else min(best, seconds)
+    return result, best
+
+def percentile(sorted_values, percent):
+    index = int(math.ceil(percent / 100.0 * len(sorted_values))) - 1
+    return sorted_values[max(index, 0)]
+
+def scale_tuas(body, scale, tua_re):
+    """
+    Returns body with scale times the TUAs: each TUA is split into up to
+    scale TUAs of its words, and the body is repeated as many times as that
+    falls short. TUAs holding other tags or brackets are left whole.
+    """
+    if scale == 1:
+        return body
+    counts = [0, 0]
+
+    def split(match):
+        t_id, t_type, t_body = match.group('tua_id', 'tua_type', 'tua_body')
+        counts[0] += 1
+        words = t_body.split()
+        if '<' in t_body or '[' in t_body or ']' in t_body or len(words) < 2:
+            counts[1] += 1
+            return match.group(0)
+        pieces = min(scale, len(words))
+        counts[1] += pieces
+        bounds = [len(words) * i // pieces for i in range(pieces + 1)]
+        return ' '.join('<%s><%s>%s/></>' % (t_id or 1, t_type,
+                                              ' '.join(words[start:end]))
+                        for start, end in zip(bounds, bounds[1:]))
+
+    body = tua_re.sub(split, body)
+    if not counts[0]:
+        return body
+    repeat = int(math.ceil(scale * counts[0] / float(counts[1])))
+    return '\n'.join([body] * repeat)
+
+def scaled_article_dirs(article_dir, scales, tmp_dir, tua_re):
+    """
+    Writes the articles of article_dir scaled to each scale to a directory
+    under tmp_dir, and returns {scale: directory}.
+    """
+    dirs = {}
+    names = sorted(name for name in os.listdir(article_dir)
+                   if name.endswith('.txt'))
+    for scale in scales:
+        if scale == 1:
+            dirs[scale] = article_dir
+            continue
+        dirs[scale] = os.path.join(tmp_dir, 'articles_%dx' % scale)
+        os.mkdir(dirs[scale])
+        for name in names:
+            with open(os.path.join(article_dir, name), 'r') as f:
+                raw_text = f.read()
+            match = HEADER_RE.match(raw_text)
+            if match:
+                header = match.group(1)
+                raw_text = header + scale_tuas(raw_text[len(header):], scale,
+                                               tua_re)
+            with open(os.path.join(dirs[scale], name), 'w') as f:
+                f.write(raw_text)
+    return dirs
+
+def bench_parse_document(article_dir, repeat):
+    """
+    Times parse_document on every article of article_dir. Returns the
+    results and the parsed articles.
+    """
+    from data.parse_document import ArticleParseError, parse_document
+    times = []
+    articles = []
+    errors = 0
+    for name in sorted(os.listdir(article_dir)):
+        if not name.endswith('.txt'):
+            continue
+        try:
+            article, seconds = fastest(repeat, parse_document,
+                                       os.path.join(article_dir, name))
+        except ArticleParseError:
+            errors += 1
+            continue
+        times.append(seconds)
+        articles.append(article)
+    tuas = sum(len(offsets) for article in articles
+               for tuas in article['tuas'].values()
+               for offsets in tuas.values())
+    characters = sum(len(article['text']) for article in articles)
+    return stats(times, errors=errors, tuas=tuas,
+                 characters=characters), articles
+
+def bench_parse_and_clean_tuas(article_dir, repeat):
+    """
+    Times parse_and_clean_tuas on the headerless text of every article of
+    article_dir.
+    """
+    from data.parse_document import (ArticleParseError, parse_and_clean_tuas,
+                                     parse_header)
+    times = []
+    errors = 0
+    for name in sorted(os.listdir(article_dir)):
+        if not name.endswith('.txt'):
+            continue
+        with open(os.path.join(article_dir, name), 'r') as f:
+            raw_text = f.read()
+        try:
+            text = parse_header(raw_text)[0]
+        except ArticleParseError:
+            continue
+        try:
+            times.append(fastest(repeat, parse_and_clean_tuas, text)[1])
+        except ArticleParseError:
+            errors += 1
+    return stats(times, errors=errors)
+
+def bench_parse_schema(schema_dir, repeat):
+    from data.parse_schema import parse_schema
+    times = []
+    for name in sorted(os.listdir(schema_dir)):
+        if not name.endswith('.txt'):
+            continue
+        times.append(fastest(repeat, parse_schema,
+                             os.path.join(schema_dir, name))[1])
+    return stats(times)
+
+def bench_load(schema_dir, articles_by_scale):
+    """
+    Times loading the schemas, then load_article on the parsed articles of
+    each scale, starting from empty tables each time.
+    """
+    from django.core.management import call_command
+    from data.parse_schema import parse_schema
+    from load_data import load_article, load_schema
+    from thresher.models import Article, HighlightGroup, Topic
+
+    call_command('syncdb', interactive=False, verbosity=0)
+    HighlightGroup.objects.all().delete()
+    Article.objects.all().delete()
+    Topic.objects.all().delete()
+
+    # In order, parent schemas before their children
+    results = {}
+    times = []
+    for name in sorted(os.listdir(schema_dir)):
+        if not name.endswith('.txt'):
+            continue
+        schema = parse_schema(os.path.join(schema_dir, name))
+        start = time.time()
+        load_schema(schema)
+        times.append(time.time() - start)
+    results['load_schema'] = stats(times)
+
+    for scale, articles in sorted(articles_by_scale.items()):
+        times = []
+        for article in articles:
+            start = time.time()
+            load_article(article)
+            times.append(time.time() - start)
+        results['load_article_%dx' % scale] = stats(times)
+        HighlightGroup.objects.all().delete()
+        Article.objects.all().delete()
+    return results
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=BASE_DIR,
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(args):
+    # The parser and loader print progress, which isn't part of the report
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    tmp_dir = tempfile.mkdtemp(prefix='thresher_benchmark_')
+    try:
+        # Before anything loads the settings, which read it
+        if not args.database_url:
+            os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(
+                tmp_dir, 'benchmark.db')
+        else:
+            os.environ['DATABASE_URL'] = args.database_url
+        from django.db import connection
+        from data.parse_document import TUA_PATTERN
+
+        report = {
+            'commit': git_commit(),
+            'date': datetime.utcnow().isoformat(),
+            'python': platform.python_version(),
+            'repeat': args.repeat,
+            'database': connection.vendor,
+            'benchmarks': {},
+        }
+        benchmarks = report['benchmarks']
+        dirs = scaled_article_dirs(args.article_dir, args.scales, tmp_dir,
+                                   TUA_PATTERN)
+        articles_by_scale = {}
+        for scale in args.scales:
+            progress('parsing articles at %dx' % scale)
+            benchmarks['parse_document_%dx' % scale], articles = \
+                bench_parse_document(dirs[scale], args.repeat)
+            articles_by_scale[scale] = articles
+            benchmarks['parse_and_clean_tuas_%dx' % scale] = \
+                bench_parse_and_clean_tuas(dirs[scale], args.repeat)
+
+        progress('parsing schemas')
+        benchmarks['parse_schema'] = bench_parse_schema(args.schema_dir,
+                                                        args.repeat)
+        if not args.skip_load:
+            progress('loading')
+            benchmarks.update(bench_load(args.schema_dir, articles_by_scale))
+        return report
+    finally:
+        sys.stdout = stdout
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def compare(report, baseline, threshold):
+    """
+    Prints the change in mean time of every benchmark in both reports, and
+    returns the names of those that got slower by more than threshold.
+    """
+    regressions = []
+    for name in sorted(report['benchmarks']):
+        new = report['benchmarks'][name].get('mean_seconds')
+        old = baseline['benchmarks'].get(name, {}).get('mean_seconds')
+        if not new or not old:
+            continue
+        change = new / old - 1
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        progress('%-28s %10.6fs -> %10.6fs %+7.1f%%%s' % (
+            name, old, new, change * 100, flag))
+    return regressions
+
+def progress(message):
+    sys.stderr.write(message + '\n')
+
+def benchmark_args():
+    parser = argparse.ArgumentParser(
+        description='Times the document parser and loader')
+    parser.add_argument(
+        '-o', '--output',
+        help='The file to write the JSON report to (default: standard output)')
+    parser.add_argument(
+        '-c', '--compare',
+        help='A report to compare with. Exits with status 1 on a regression')
+    parser.add_argument(
+        '-t', '--threshold',
+        type=float,
+        default=THRESHOLD,
+        help='The slowdown that counts as a regression, as a fraction')
+    parser.add_argument(
+        '-s', '--scales',
+        type=lambda value: [int(scale) for scale in value.split(',')],
+        default=list(SCALES),
+        help='Comma separated TUA scales to benchmark (default: 1,10,100)')
+    parser.add_argument(
+        '-d', '--article-dir',
+        default=ARTICLE_DIR,
+        help='The directory of raw articles')
+    parser.add_argument(
+        '--schema-dir',
+        default=SCHEMA_DIR,
+        help='The directory of raw schemas')
+    parser.add_argument(
+        '-r', '--repeat',
+        type=int,
+        default=REPEAT,
+        help=('The number of times each article and schema is parsed, '
+              'keeping the fastest'))
+    parser.add_argument(
+        '--skip-load',
+        action='store_true',
+        default=False,
+        help="Don't benchmark loading into the database")
+    parser.add_argument(
+        '--database-url',
+        help=('The database to benchmark loading with. Its thresher tables '
+              'are emptied! (default: a temporary SQLite database)'))
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE',
+                          'thresher_backend.settings')
+    args = benchmark_args()
+    report = run(args)
+    content = json.dumps(report, indent=1, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(content + '\n')
+    else:
+        print content
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        if compare(report, baseline, args.threshold):
+            sys.exit(1)
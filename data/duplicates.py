@@ -0,0 +1,117 @@
+# Finds articles whose text is nearly the same as an article seen before, such
+# as the same wire story printed by two periodicals.
+#
+# Each article is reduced to a MinHash signature of its shingles (runs of
+# SHINGLE_WORDS words): SIGNATURE_SIZE minimums of as many hash functions,
+# where the share of equal minimums of two articles estimates the Jaccard
+# similarity of their shingles. Signatures are split into BANDS bands, and
+# only articles that share a whole band are compared, so an article is checked
+# against a handful of candidates instead of every article seen.
+#
+# The index is kept in memory, or in a dbm hash file that persists it from one
+# load to the next. Articles found not to be duplicates are held back until
+# commit, so an index file only ever names articles that were written.
+
+import anydbm
+import zlib
+
+import numpy as np
+
+SHINGLE_WORDS = 5
+SIGNATURE_SIZE = 64
+BANDS = 16
+
+# The estimated Jaccard similarity over which an article is a near duplicate
+THRESHOLD = 0.8
+
+# The hash functions are (a * x + b) % PRIME, with the same a and b in every
+# process so that stored signatures stay comparable
+PRIME = (1 << 31) - 1
+_random = np.random.RandomState(1)
+HASH_A = _random.randint(1, PRIME, SIGNATURE_SIZE).astype(np.uint64)
+HASH_B = _random.randint(0, PRIME, SIGNATURE_SIZE).astype(np.uint64)
+
+def shingles(text, size=SHINGLE_WORDS):
+    # The set of runs of size words of text, ignoring case and spacing.
+    # Parsed files give UTF-8 bytes and JSON lines unicode, which must give
+    # the same shingles.
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'replace')
+    words = text.lower().split()
+    if len(words) <= size:
+        return set([' '.join(words)]) if words else set()
+    return set(' '.join(words[i:i + size])
+               for i in xrange(len(words) - size + 1))
+
+def signature(text):
+    # The MinHash signature of text, or None if it has no words
+    text_shingles = shingles(text)
+    if not text_shingles:
+        return None
+    hashes = np.fromiter((zlib.crc32(shingle.encode('utf-8')) & 0xffffffff
+                          for shingle in text_shingles),
+                         dtype=np.uint64, count=len(text_shingles)) % PRIME
+    return ((np.outer(HASH_A, hashes) + HASH_B[:, np.newaxis]) % PRIME) \
+        .min(axis=1).astype(np.uint32)
+
+def similarity(a, b):
+    # The Jaccard similarity estimated from two signatures
+    return np.count_nonzero(a == b) / float(len(a))
+
+class NearDuplicateIndex(object):
+    # The signatures of the articles seen, and the articles with each band of
+    # signature. With a path the index is stored in a dbm file there, which
+    # is emptied first with reset.
+    def __init__(self, path=None, threshold=THRESHOLD, reset=False):
+        self.path = path
+        self.threshold = threshold
+        self.db = anydbm.open(path, 'n' if reset else 'c') if path else {}
+        # The entries of the articles found since the last commit
+        self.pending = {}
+
+    def get(self, key):
+        # The value of key, pending or committed, or None
+        if key in self.pending:
+            return self.pending[key]
+        return self.db[key] if key in self.db else None
+
+    def find(self, article_id, text):
+        # Returns the id of an article, in the index or found since the last
+        # commit, that text is a near duplicate of, or None. Otherwise the
+        # article is added to the index on the next commit.
+        article_id = str(article_id)
+        article_signature = signature(text)
+        if article_signature is None:
+            return None
+
+        bands = ['band:%d:%s' % (i, band.tostring().encode('hex'))
+                 for i, band in enumerate(
+                     np.split(article_signature, BANDS))]
+        candidates = set()
+        for band in bands:
+            candidates.update((self.get(band) or '').split())
+        candidates.discard(article_id)
+        for candidate in sorted(candidates):
+            other = np.frombuffer(self.get('signature:' + candidate),
+                                  dtype=np.uint32)
+            if similarity(article_signature, other) >= self.threshold:
+                return candidate
+
+        if self.get('signature:' + article_id) is None:
+            self.pending['signature:' + article_id] = \
+                article_signature.tostring()
+            for band in bands:
+                ids = self.get(band)
+                self.pending[band] = ids + ' ' + article_id if ids \
+                    else article_id
+        return None
+
+    def commit(self):
+        # Adds the articles found since the last commit to the index
+        for key, value in self.pending.iteritems():
+            self.db[key] = value
+        self.pending = {}
+
+    def close(self):
+        if self.path:
+            self.db.close()
@@ -1,24 +1,31 @@
+# Parses raw article files. This module doesn't depend on Django, so that it
+# can run on its own and parser processes start quickly; everything it reads
+# besides the articles is passed in explicitly.
+
+import argparse
 import codecs
 import json
 import os
 import re
-import sys
+import string
 from datetime import date
-from django.conf import settings
 
-DATA_FOLDER = os.path.join(settings.BASE_DIR, 'data')
+# The default data folder: the one holding this module
+DATA_FOLDER = os.path.dirname(os.path.abspath(__file__))
 
+# The folders of the data folder that parse_documents reads articles from and
+# moves articles that failed to parse to
 #SUCCESS_FOLDER = "DecidingForceArticles"
-ARTICLE_FOLDER = os.path.join(DATA_FOLDER, "DecidingForceArticles")
-FILENAME_ERROR_FOLDER = os.path.join(DATA_FOLDER, "DecidingForceErrors/filename")
-HEADER_ERROR_FOLDER = os.path.join(DATA_FOLDER, "DecidingForceErrors/header")
-TEXT_ERROR_FOLDER = os.path.join(DATA_FOLDER, "DecidingForceErrors/text")
-DUPLICATES_ERROR_FOLDER = os.path.join(DATA_FOLDER, "DecidingForceErrors/duplicates")
-WARNING_FOLDER = os.path.join(DATA_FOLDER, "DecidingForceErrors/warning")
+ARTICLE_FOLDER = "DecidingForceArticles"
+FILENAME_ERROR_FOLDER = "DecidingForceErrors/filename"
+HEADER_ERROR_FOLDER = "DecidingForceErrors/header"
+TEXT_ERROR_FOLDER = "DecidingForceErrors/text"
+DUPLICATES_ERROR_FOLDER = "DecidingForceErrors/duplicates"
+WARNING_FOLDER = "DecidingForceErrors/warning"
 #ARTICLE_FOLDER = "DecidingForceArticles_Sample/"
 
 # List of known duplicates
-DUPLICATES_FILE = os.path.join(DATA_FOLDER,"duplicates.txt")
+DUPLICATES_FILE = os.path.join(DATA_FOLDER, "duplicates.txt")
 
 # Format of the article filenames.
 # Example: 1000BethlehemPA-LehighValleyLive-02.txt
@@ -61,6 +68,21 @@ ANNO_RE = r'(<!!>)?\s*(?P<annotator>[A-Z]+)\s*(</>)?'
 # Format of the version. Example: v23
 VERSION_RE = r'v(?P<version>\d+)'
 
+# The number of leading characters of an article split into lines at first
+# when looking for the header
+HEADER_CHUNK_SIZE = 1024
+
+# The patterns above, compiled once and reused for every document
+FILENAME_PATTERN = re.compile(FILENAME_RE)
+TUA_PATTERN = re.compile(TUA_RE)
+BRACKET_PATTERN = re.compile(BRACKET_RE)
+DATE_HEADER_PATTERN = re.compile(DATE_HEADER_RE)
+ANNO_PATTERN = re.compile(ANNO_RE)
+VERSION_PATTERN = re.compile(VERSION_RE)
+
+# Lower-cases ASCII letters only, the way re.I compares byte strings
+LOWER_CASE = string.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
 class ArticleParseError(Exception):
     FILENAME_ERROR = 0
     HEADER_ERROR = 1
@@ -72,8 +94,14 @@ class ArticleParseError(Exception):
         super(ArticleParseError, self).__init__(message)
         self.error_type = error_type
 
+    def __reduce__(self):
+        # Keep the error type when the error is sent back from a worker process
+        return (ArticleParseError, (self.args[0], self.error_type))
 
-def parse_document(path):
+
+def parse_document(path, duplicates=None):
+    # Parses the article file at path. duplicates holds the ids of the known
+    # duplicate articles, by default those of DUPLICATES_FILE.
     with open(path, 'r') as f:
         raw_text = f.read()
 
@@ -81,7 +109,9 @@ def parse_document(path):
     article_id, city, state, periodical, periodical_code = parse_filename(path)
 
     # don't parse known duplicates
-    if article_id in parse_duplicates():
+    if duplicates is None:
+        duplicates = parse_duplicates()
+    if article_id in duplicates:
         raise ArticleParseError("Article %s is known duplicate!" % article_id,
                                 ArticleParseError.DUPLICATE_ERROR)
 
@@ -155,9 +185,11 @@ def parse_header(raw_text):
     #   +*+*      <-- special separator text
     #   11-5-11   <-- Date published (month-day-year)
     #   <!!>SLG</>, v23  <-- annotators and version number
-    lines = raw_text.splitlines()
+    #
+    # Lines are only split off until the end of the header, which is usually
+    # at the top of the article.
     header_rownum = 1
-    for i, line in enumerate(lines):
+    for line, line_end in iter_lines(raw_text):
         # Remove windows UTF-8 junk
         if line.startswith(codecs.BOM_UTF8):
             line = line[3:]
@@ -186,13 +218,31 @@ def parse_header(raw_text):
     if header_rownum != 3:
         raise ArticleParseError("Not all header lines found!",
                                 ArticleParseError.HEADER_ERROR)
-    headerless_text = '\n'.join(lines[i+1:]).strip()
+    headerless_text = raw_text[line_end:]
+    if '\r' in headerless_text:
+        headerless_text = '\n'.join(headerless_text.splitlines())
+    headerless_text = headerless_text.strip()
     return (headerless_text, date_published, annotators, version)
 
+def iter_lines(text, chunk_size=HEADER_CHUNK_SIZE):
+    # Yields the lines of text as str.splitlines splits them, each with the
+    # offset after its line break. Text is split a chunk at a time, so only
+    # the chunks holding the lines read are split.
+    pos = 0
+    while pos < len(text):
+        lines = text[pos:pos + chunk_size].splitlines(True)
+        if pos + chunk_size < len(text):
+            # The last line may go on in the next chunk
+            lines.pop()
+        for line in lines:
+            pos += len(line)
+            yield line.rstrip('\r\n'), pos
+        chunk_size *= 2
+
 def parse_date_line(raw_text):
     # Format: month-day-year
     # Example: 11-8-11
-    match = re.search(DATE_HEADER_RE, raw_text)
+    match = DATE_HEADER_PATTERN.search(raw_text)
     date_published = None
     if match:
         month, day, year = match.group('month', 'day', 'year')
@@ -215,54 +265,174 @@ def parse_annotator_line(raw_text):
     #   <!!>CRV</>, v26, <!!> EDC</>
     annotators = []
     version = None
-    for anno_match in re.finditer(ANNO_RE, raw_text):
+    for anno_match in ANNO_PATTERN.finditer(raw_text):
         annotators.append(anno_match.group('annotator'))
-    version_match = re.search(VERSION_RE, raw_text)
+    version_match = VERSION_PATTERN.search(raw_text)
     if version_match:
         version = version_match.group('version')
     return (annotators, version)
 
+class CleanText(object):
+    # The clean text built up by parse_and_clean_tuas. Text is only ever added
+    # or trimmed at the end, so its length doubles as the map from the raw
+    # offset being scanned to the clean offset it ends up at.
+    def __init__(self):
+        self.chunks = []
+        self.length = 0
+        self.blank = True # nothing but spaces so far
+
+    def append(self, text):
+        if not text:
+            return
+        self.chunks.append(text)
+        self.length += len(text)
+        if self.blank and text.strip(' '):
+            self.blank = False
+
+    def last_char(self):
+        return self.chunks[-1][-1] if self.chunks else ''
+
+    def rstrip(self):
+        # Remove trailing spaces, as merge_safe does to its left string
+        while self.chunks:
+            chunk = self.chunks.pop()
+            stripped = chunk.rstrip(' ')
+            self.length -= len(chunk) - len(stripped)
+            if stripped:
+                self.chunks.append(stripped)
+                break
+
+    def truncate(self, length):
+        # Cut the text down to length characters and return the rest
+        value = self.getvalue()
+        self.chunks = []
+        self.length = 0
+        self.blank = True
+        self.append(value[:length])
+        return value[length:]
+
+    def getvalue(self):
+        if len(self.chunks) > 1:
+            self.chunks = [''.join(self.chunks)]
+        return self.chunks[0] if self.chunks else ''
+
+    def merge(self, text):
+        # Add text with the spacing rules of merge_with_spacing and return the
+        # offset the added text starts at.
+        if not text.strip(' '):
+            return self.length
+        if self.chunks:
+            separator = requires_separator(self.last_char(), text)
+            self.rstrip()
+            if separator:
+                self.append(' ')
+            text = text.lstrip(' ')
+        self.append(text)
+        return self.length - len(text)
+
 def parse_and_clean_tuas(raw_text):
     # Extract metadata about TUAs and clean their tags out of the text.
     # See TUA_RE above for TUA formatting.
+    #
+    # The text is scanned once, left to right. Everything before the current
+    # tag is already clean, so spans are read off the clean text's length
+    # instead of being searched for again after every tag removal.
 
     tuas = []
     tuas_to_finalize = []
-    match = re.search(TUA_RE, raw_text)
+    clean = CleanText()
+    text = raw_text
+    pos = 0
+    text_end = len(text.rstrip(' ')) # anything after this is just spaces
+    match = TUA_PATTERN.search(text, pos)
     while match:
         t_id, t_type, t_body = match.group('tua_id', 'tua_type', 'tua_body')
         t_id = 1 if t_id is None else t_id
+        m_start, m_end = match.span()
+        clean.append(text[pos:m_start])
 
         # Brackets represent back-references to previous text. We need to
         # create TUAs to capture the references to the previous text, then
         # remove the bracketed text from the article.
-        has_brackets, clean_text, new_tuas = extract_bracket_text(match, raw_text)
+        # brackets might be anywhere starting from the character before the
+        # match to the character after it.
+        prev_char = clean.last_char()
+        bracket_area = prev_char + text[m_start:m_end + 1]
+        has_brackets = (prev_char and ('[' in bracket_area[:-1]
+                                       or ']' in bracket_area[1:]))
+        new_tuas = []
         if has_brackets:
-            raw_text = clean_text
-            for new_tua_body, new_tua_index, num_matches in new_tuas:
-                if new_tua_index == 0: # forward reference--we need to wait.
-                    tuas_to_finalize.append((t_id, t_type, new_tua_body,
-                                             new_tua_index))
-                else:
-                    t_span = get_match_span_by_index(
-                        re.escape(new_tua_body.strip()),
-                        new_tua_index, raw_text)
-                    tuas.append((t_id, t_type, new_tua_body, t_span))
-        else: # No brackets to remove, just parse and clean the TUA.
-            t_start = match.start('tua_body')
-            t_index, _ = find_match_index(re.escape(t_body), t_start, raw_text)
-            raw_text = merge_with_spacing((raw_text[:match.start()],
-                                          t_body,
-                                           raw_text[match.end():]))
-            t_span = get_match_span_by_index(re.escape(t_body.strip()), t_index,
-                                             raw_text)
+            body, new_tuas = extract_bracket_text(match, text, clean)
+            if prev_char == '[':
+                clean.truncate(clean.length - 1)
+            cut_end = m_end + 1 if text[m_end:m_end + 1] == ']' else m_end
+        else:
+            body = t_body
+            cut_end = m_end
+            if t_body != t_body.strip():
+                # Spans are looked up by the stripped body, so earlier
+                # occurrences of the stripped text can shift which occurrence
+                # gets picked. Count them the way the tags were always
+                # matched to keep the same spans.
+                t_index = find_match_index(
+                    t_body,
+                    clean.length + match.start('tua_body') - m_start,
+                    clean.getvalue() + text[m_start:match.end('tua_body')])
+
+        # Merge the remaining body and the rest of the text into the clean
+        # text, the way merge_with_spacing would merge the whole article.
+        if clean.blank:
+            clean.truncate(0)
+        body_start = clean.merge(body)
+        body_end = clean.length
+        if cut_end < text_end:
+            pos = cut_end
+            if clean.chunks:
+                separator = requires_separator(clean.last_char(),
+                                               text[pos:pos + 2])
+                clean.rstrip()
+                if separator:
+                    clean.append(' ')
+                while text[pos:pos + 1] == ' ':
+                    pos += 1
+        else:
+            pos = len(text)
+
+        if not has_brackets:
+            # No brackets to remove, just record the span of the TUA.
+            if t_body != t_body.strip():
+                t_span = get_match_span_by_index(
+                    t_body.strip(), t_index,
+                    clean.getvalue(), text[pos:])
+            else:
+                t_start = body_end - len(body)
+                t_span = (t_start, body_end)
             tuas.append((t_id, t_type, t_body, t_span))
-        match = re.search(TUA_RE, raw_text)
 
+        for new_tua_body, new_tua_index in new_tuas:
+            if new_tua_index == 0: # forward reference--we need to wait.
+                tuas_to_finalize.append((t_id, t_type, new_tua_body,
+                                         new_tua_index))
+            else:
+                t_span = get_match_span_by_index(
+                    new_tua_body.strip(), new_tua_index,
+                    clean.getvalue(), text[pos:])
+                tuas.append((t_id, t_type, new_tua_body, t_span))
+
+        if '<' in body:
+            # The body holds the start of another tag, so it has to be scanned
+            # again together with the text that follows it.
+            text = clean.truncate(body_start) + text[pos:]
+            pos = 0
+            text_end = len(text.rstrip(' '))
+        match = TUA_PATTERN.search(text, pos)
+
+    clean.append(text[pos:])
+    clean_text = clean.getvalue()
     for t_id, t_type, t_body, t_index in tuas_to_finalize:
         try:
-            t_span = get_match_span_by_index(re.escape(t_body.strip()), t_index,
-                                             raw_text)
+            t_span = get_match_span_by_index(t_body.strip(), t_index,
+                                             clean_text)
             tuas.append((t_id, t_type, t_body, t_span))
 
         # This wasn't a forward reference--just normally occuring brackets.
@@ -272,69 +442,102 @@ def parse_and_clean_tuas(raw_text):
         except ArticleParseError:
             pass
 
-    return (tuas, raw_text)
-
-def find_match_index(regex, match_start, source_text):
-    # if regex matches multiple times in source_text, return the index of the
-    # match that begins at offset match_start.
-    # Returns None if there is no such match
-    match_index = None
-    num_matches = 0
-    for match_num, match in enumerate(re.finditer(regex, source_text, re.I)):
-        num_matches += 1
-        if match.start() == match_start:
-            match_index = match_num
-    return (match_index, num_matches)
-
-def get_match_span_by_index(regex, match_index, source_text):
-    # Return the index into source_text where regex matches the text for the
-    # match_index'th time.
-    for match_num, match in enumerate(re.finditer(regex, source_text, re.I)):
-        if match_num == match_index:
-            return match.span()
+    return (tuas, clean_text)
+
+def find_match_index(needle, match_start, source_text):
+    # if needle occurs multiple times in source_text (ignoring case), return
+    # the index of the occurrence that begins at offset match_start.
+    # Occurrences are counted like re.finditer counts matches: left to right,
+    # without overlaps.
+    # Returns None if there is no such occurrence
+    needle = needle.translate(LOWER_CASE)
+    source_text = source_text.translate(LOWER_CASE)
+    if not needle:
+        return match_start if match_start <= len(source_text) else None
+
+    if not has_border(needle):
+        # Occurrences can't overlap, so every one of them counts.
+        if source_text.startswith(needle, match_start):
+            return source_text.count(needle, 0, match_start)
+        return None
+
+    match_num = 0
+    start = source_text.find(needle)
+    while 0 <= start <= match_start:
+        if start == match_start:
+            return match_num
+        match_num += 1
+        start = source_text.find(needle, start + len(needle))
+    return None
+
+def get_match_span_by_index(needle, match_index, source_text, rest_text=''):
+    # Return the span in source_text + rest_text where needle occurs (ignoring
+    # case) for the match_index'th time. rest_text is only searched when
+    # source_text alone doesn't have enough occurrences.
+    lower_needle = needle.translate(LOWER_CASE)
+    lower_text = source_text.translate(LOWER_CASE)
+    if match_index is not None:
+        if not lower_needle:
+            # The empty string occurs at every offset
+            if match_index <= len(lower_text):
+                return (match_index, match_index)
+        else:
+            start = lower_text.find(lower_needle)
+            for match_num in xrange(match_index):
+                if start == -1:
+                    break
+                start = lower_text.find(lower_needle, start + len(needle))
+            if start != -1:
+                return (start, start + len(needle))
+    if rest_text:
+        return get_match_span_by_index(needle, match_index,
+                                       source_text + rest_text)
     raise ArticleParseError("Match doesn't occur correct number of times",
                             ArticleParseError.TEXT_ERROR)
 
-def extract_bracket_text(match, source_text):
-    # brackets might be anywhere starting from the character before the match to
-    # the character after it.
-    m_start, m_end = match.span()
-    bracket_area = source_text[m_start-1:m_end+1]
-    if '[' not in bracket_area[:-1] and ']' not in bracket_area[1:]:
-        return (False, '', [])
+def has_border(text):
+    # Whether a proper prefix of text is also a suffix of it, i.e. whether two
+    # occurrences of text can overlap.
+    return any(text.startswith(text[-i:]) for i in xrange(1, len(text)))
 
+def extract_bracket_text(match, source_text, clean):
+    # Find the bracketed back-references around a TUA match in source_text,
+    # where clean holds the already cleaned text before the match.
+    # Returns the part of the TUA body that stays in the article and the
+    # (text, match index) of each back-reference.
+    m_start, m_end = match.span()
     body_start, body_end = match.span('tua_body')
-    try:
-        cut_start = m_start if source_text[m_start-1] != '[' else m_start - 1
-    except IndexError:
-        cut_start = 0
 
-    try:
-        cut_end = m_end if source_text[m_end] != ']' else m_end + 1
-    except IndexError:
-        cut_end = m_end
+    # Offsets in the bracket area are relative to the character before the
+    # match, which is already part of the clean text.
+    area_start = m_start - 1
+    clean_area_start = clean.length - 1
+    bracket_area = clean.last_char() + source_text[m_start:m_end + 1]
+    prefix_text = None
 
     bits_to_keep = []
     keep_start_index = body_start
     tuas_to_create = []
-    for bracket in re.finditer(BRACKET_RE, source_text[m_start-1:m_end+1]):
+    for bracket in BRACKET_PATTERN.finditer(bracket_area):
         # Find the backreference in the article text and set up a new TUA.
         bracket_text = bracket.group('text')
         if bracket_text == 'DT': # special case--this is never a true bracket.
             continue
-        bracket_text_index, num_matches = find_match_index(
-            re.escape(bracket_text),
-            m_start - 1 + bracket.start('text'),
-            source_text)
+        if prefix_text is None:
+            prefix_text = clean.getvalue() + source_text[m_start:m_end + 1]
+        bracket_text_index = find_match_index(
+            bracket_text,
+            clean_area_start + bracket.start('text'),
+            prefix_text)
         # at least one occurrence before the bracket--back reference.
         if bracket_text_index != 0:
             bracket_text_index -= 1
-        tuas_to_create.append((bracket_text, bracket_text_index, num_matches))
+        tuas_to_create.append((bracket_text, bracket_text_index))
 
         # Track the text we need to remove
         # The bracket match is relative to the TUA match, so ajdust the offset.
-        bracket_start = bracket.start() + m_start - 1
-        bracket_end = bracket.end() + m_start - 1
+        bracket_start = bracket.start() + area_start
+        bracket_end = bracket.end() + area_start
         bits_to_keep.append((keep_start_index,
                              max(bracket_start, body_start)))
         keep_start_index = min(bracket_end, body_end)
@@ -343,10 +546,7 @@ def extract_bracket_text(match, source_text):
     bits_to_keep.append((keep_start_index, body_end))
     remaining_body = merge_with_spacing([source_text[span[0]:span[1]]
                                          for span in bits_to_keep])
-    clean_text = merge_with_spacing((source_text[:cut_start],
-                                     remaining_body,
-                                     source_text[cut_end:]))
-    return (True, clean_text, tuas_to_create)
+    return (remaining_body, tuas_to_create)
 
 def merge_with_spacing(string_bits):
     # Merge the strings in string_bits with exactly n_spaces spaces between them
@@ -382,7 +582,7 @@ def requires_separator(a, b):
 def parse_filename(filename):
     # Extract metadata from the filename. See FILENAME_RE for formatting info.
     raw_name = os.path.basename(filename)
-    match = re.search(FILENAME_RE, raw_name)
+    match = FILENAME_PATTERN.search(raw_name)
     if match:
         return match.group('article_id', 'city', 'state', 'periodical',
                            'periodical_code')
@@ -390,12 +590,35 @@ def parse_filename(filename):
         raise ArticleParseError('Bad File Name: ' + raw_name,
                                 ArticleParseError.FILENAME_ERROR)
 
-def parse_duplicates():
-    with open(DUPLICATES_FILE, 'r') as dup_f:
-        return dup_f.readlines()
-
-def parse_documents(directory_path, error_directory_paths):
-    data = []
+def normalize_article_id(article_id):
+    # Article ids are compared as numbers: ' 0412\n' is 412
+    article_id = str(article_id).strip()
+    return str(int(article_id)) if article_id.isdigit() else article_id
+
+class DuplicateRegistry(object):
+    # The ids of the known duplicate articles listed in a file, one per line.
+    def __init__(self, path):
+        self.ids = set()
+        if os.path.exists(path):
+            with open(path, 'r') as dup_f:
+                for line in dup_f:
+                    if line.strip() and not line.startswith('#'):
+                        self.ids.add(normalize_article_id(line))
+
+    def __contains__(self, article_id):
+        return normalize_article_id(article_id) in self.ids
+
+# The registry of each duplicates file, read once per process
+_duplicate_registries = {}
+
+def parse_duplicates(path=DUPLICATES_FILE):
+    if path not in _duplicate_registries:
+        _duplicate_registries[path] = DuplicateRegistry(path)
+    return _duplicate_registries[path]
+
+def parse_documents(directory_path, error_directory_paths, duplicates=None):
+    # Parse the articles in directory_path one at a time, moving the ones that
+    # fail to parse to the error directory for their error type.
     for file_path in os.listdir(directory_path):
         full_path = os.path.join(directory_path, file_path)
         if '.gitignore' in file_path or os.path.isdir(full_path):
@@ -403,15 +626,54 @@ def parse_documents(directory_path, error_directory_paths):
         print "PROCCESING FILE:", file_path, "..."
 
         try:
-            data.append(parse_document(full_path))
+            article = parse_document(full_path, duplicates)
         except ArticleParseError as e:
             new_path = os.path.join(error_directory_paths[e.error_type],
                                     file_path)
             os.rename(full_path, new_path)
             print "ERROR!"
-    return data
+            continue
+        yield article
+
+def dthandler(obj):
+    if isinstance(obj, date):
+        return obj.isoformat()
+
+def write_jsonl(articles, out_file):
+    # Write one parsed article per line, so that articles can be written and
+    # read back one at a time.
+    for article in articles:
+        out_file.write(json.dumps(article, default=dthandler))
+        out_file.write('\n')
+
+def read_jsonl(path):
+    with open(path, 'r') as in_file:
+        for line in in_file:
+            if line.strip():
+                yield json.loads(line)
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description=('Parses raw articles to a JSON lines file, one article '
+                     'per line'))
+    parser.add_argument(
+        'filename',
+        nargs='?',
+        help=('A single article to parse (default: every article of the '
+              'DecidingForceArticles folder of the data folder)'))
+    parser.add_argument(
+        '--data-folder',
+        default=DATA_FOLDER,
+        help=('The folder holding DecidingForceArticles, DecidingForceErrors '
+              'and duplicates.txt (default: %s)' % DATA_FOLDER))
+    parser.add_argument(
+        '-o', '--output',
+        default='data.txt',
+        help='The file to write the parsed articles to (default: data.txt)')
+    return parser.parse_args()
 
 if __name__ == '__main__':
+    args = parse_args()
     error_dirs = {
         ArticleParseError.FILENAME_ERROR : FILENAME_ERROR_FOLDER,
         ArticleParseError.HEADER_ERROR : HEADER_ERROR_FOLDER,
@@ -419,19 +681,21 @@ if __name__ == '__main__':
         ArticleParseError.DUPLICATE_ERROR: DUPLICATES_ERROR_FOLDER,
         ArticleParseError.BRACKET_WARNING: WARNING_FOLDER
     }
+    for error_type, folder in error_dirs.items():
+        error_dirs[error_type] = os.path.join(args.data_folder, folder)
+    duplicates = parse_duplicates(os.path.join(args.data_folder,
+                                               'duplicates.txt'))
 
-    if len(sys.argv) > 1:
+    if args.filename:
         data = []
-        file_path = sys.argv[1]
         try:
-            data.append(parse_document(file_path))
+            data.append(parse_document(args.filename, duplicates))
         except ArticleParseError as e:
             print e
     else:
-        data = parse_documents(ARTICLE_FOLDER, error_dirs)
+        data = parse_documents(os.path.join(args.data_folder, ARTICLE_FOLDER),
+                               error_dirs, duplicates)
 
-    # dump the data to a JSON file
-    def dthandler(obj):
-        if isinstance(obj, date):
-            return obj.isoformat()
-    json.dump(data, open('data.txt', 'w'), default=dthandler)
+    # dump the data to a JSON lines file, one article per line
+    with open(args.output, 'w') as out_file:
+        write_jsonl(data, out_file)
@@ -1,6 +1,9 @@
 import argparse
+import hashlib
 import json
+import multiprocessing
 import os
+from itertools import izip
 
 os.environ['DJANGO_SETTINGS_MODULE'] = 'thresher_backend.settings'
 from django.conf import settings
@@ -8,17 +11,27 @@ from django.conf import settings
 from django.core.management import call_command
 from django.core.management.color import no_style
 from django.core.management.sql import sql_delete
-from django.db import connections, DEFAULT_DB_ALIAS, models
+from django.db import connections, DEFAULT_DB_ALIAS, models, transaction
 from django.db.utils import IntegrityError
 from django.core.exceptions import ValidationError
+from django.utils.encoding import force_text
 
-from data.parse_document import parse_document
+from data.duplicates import NearDuplicateIndex
+from data.parse_document import ArticleParseError, parse_document, read_jsonl
 from data.parse_schema import parse_schema
-from parse_schema import TopicsSchemaParser
-from thresher.models import Article, Topic, HighlightGroup, ArticleHighlight
+from parse_schema import TopicsSchemaParser, schema_changed
+from thresher.bulk import reserve_ids
+from thresher.caching import SCHEMA, HIGHLIGHTS, bump_version
+from thresher.models import (Article, Topic, HighlightGroup, ArticleHighlight,
+                             HighlightSpan, WorkUnit, CLSubmittedAnswer,
+                             DTSubmittedAnswer, MCSubmittedAnswer,
+                             SubmittedAnswerEvent, TBSubmittedAnswer)
 ANALYSIS_TYPES = {}
 HIGH_ID = 20000
 
+# Number of articles written per transaction when loading an article directory
+BATCH_SIZE = 100
+
 def load_schema(schema):
     schema_name = schema['title']
     schema_parent = schema['parent']
@@ -26,96 +39,350 @@ def load_schema(schema):
         parent = Topic.objects.get(name=schema_parent)
     else:
         parent = None
-    schema_obj = Topic(
-        parent=parent,
-        name=schema_name,
-        instructions=schema['instructions'],
-        glossary=json.dumps(schema['glossary'])
-    )
+    # The old subtopics are deleted before the new ones are loaded, so the
+    # cached schema must be invalidated even if loading them fails
     try:
-        schema_obj.save()
-    except ValidationError:
-        # we've already loaded this schema, pull it into memory.
-        print "Schema already exists. It will be overwritten"
-        curr_schema_obj = Topic.objects.get(name=schema_name)
-        # We can't just delete the object because this will delete all TUAs associated with it.
-        # Instead, we update the Analysis Type and delete all the topics associated with it.
-        # When the id is set, django automatically knows to update instead of creating a new entry.
-        schema_obj.id = curr_schema_obj.id
-        # Save the updated object
-        schema_obj.save()
-        # delete all topics associated with this Analysis Type
-        # This will CASCADE DELETE all questions and answers as well
-        Topic.objects.filter(parent=schema_obj).delete()
-
-    ANALYSIS_TYPES[schema_name] = schema_obj
-    print "loading schema:", schema_name
-
-    # Load the topics, questions and answers of the schema
-    schema_parser = TopicsSchemaParser(topic_obj=schema_obj, 
-                                       schema=schema['topics'],
-                                       dependencies=schema['dependencies'])
-    schema_parser.load_topics()
-
-def load_article(article):
-    new_id = int(article['metadata']['article_id'])
-
-    try: # Catch duplicate article ids and assign new ids.
-        existing_article = Article.objects.get(article_id=new_id)
-        if article['text'] != existing_article.text:
-            max_id = Article.objects.all().order_by('-article_id')[0].article_id
-            new_id = max_id + 1 if max_id >= HIGH_ID else HIGH_ID
-            print "NEW ID!", new_id
-        else:
-            # we've already loaded this article, so don't process its TUAs.
-            return
-
-    except Article.DoesNotExist: # Not a duplicate.
-        pass
-
-    article_obj = Article(
-        article_id=new_id,
-        text=article['text'],
-        date_published=article['metadata']['date_published'],
-        city_published=article['metadata']['city'],
-        state_published=article['metadata']['state'],
-        periodical=article['metadata']['periodical'],
-        periodical_code=int(article['metadata']['periodical_code']),
-        parse_version=article['metadata']['version'],
-        annotators=json.dumps(article['metadata']['annotators']),
-    )
-    article_obj.save()
-
-    for tua_type, tuas in article['tuas'].iteritems():
-        offsets = []
+        schema_obj = Topic(
+            parent=parent,
+            name=schema_name,
+            instructions=schema['instructions'],
+            glossary=json.dumps(schema['glossary'])
+        )
         try:
-            topic = Topic.objects.filter(name=tua_type)[0]
-            #analysis_type = (ANALYSIS_TYPES.get(tua_type) or
-            #                 Topic.objects.get(name=tua_type))
-        except IndexError:
+            schema_obj.save()
+        except ValidationError:
+            # we've already loaded this schema, pull it into memory.
+            print "Schema already exists. It will be overwritten"
+            curr_schema_obj = Topic.objects.get(name=schema_name)
+            # We can't just delete the object because this will delete all TUAs associated with it.
+            # Instead, we update the Analysis Type and delete all the topics associated with it.
+            # When the id is set, django automatically knows to update instead of creating a new entry.
+            schema_obj.id = curr_schema_obj.id
+            # Save the updated object
+            schema_obj.save()
+            # delete all topics associated with this Analysis Type
+            # This will CASCADE DELETE all questions and answers as well
+            Topic.objects.filter(parent=schema_obj).delete()
+
+        ANALYSIS_TYPES[schema_name] = schema_obj
+        print "loading schema:", schema_name
+
+        # Load the topics, questions and answers of the schema
+        schema_parser = TopicsSchemaParser(topic_obj=schema_obj, 
+                                           schema=schema['topics'],
+                                           dependencies=schema['dependencies'])
+        schema_parser.load_topics()
+    finally:
+        schema_changed()
+
+class ArticleBatchLoader(object):
+    """
+    Buffers parsed articles and writes them with one bulk_create per table,
+    inside a single transaction per batch.
+    If a manifest is given, the id every article file was loaded as is
+    recorded in it once its batch has been committed, and a changed file
+    replaces the article it was loaded as before. Skipped files are recorded
+    without an id, so that they aren't parsed again until they change.
+    If a NearDuplicateIndex is given, articles whose text is a near duplicate
+    of an article already in it or in the batch are skipped, and the others
+    are added to it once their batch has been committed.
+    """
+    def __init__(self, batch_size=BATCH_SIZE, manifest=None,
+                 near_duplicates=None):
+        self.batch_size = batch_size
+        self.manifest = manifest
+        self.near_duplicates = near_duplicates
+        self.articles = []
+        self.paths = []
+        # The files of the batch that aren't loaded
+        self.skipped_paths = []
+        # name -> Topic, loaded on the first flush
+        self.topics = None
+        # The highest article_id in the database, used to re-number duplicates
+        self.max_id = None
+
+    def add(self, article, path=None):
+        if self.near_duplicates is not None:
+            duplicate = self.near_duplicates.find(
+                article['metadata']['article_id'], article['text'])
+            if duplicate is not None:
+                print "Skipping article %s, a near duplicate of article %s" % (
+                    article['metadata']['article_id'], duplicate)
+                self.skip(path)
+                return
+        self.articles.append(article)
+        self.paths.append(path)
+        if len(self.articles) >= self.batch_size:
+            self.flush()
+
+    def skip(self, path=None):
+        if path is not None:
+            self.skipped_paths.append(path)
+
+    def flush(self):
+        loaded = []
+        if self.articles:
+            replace_ids = None
+            if self.manifest is not None:
+                replace_ids = [self.manifest.loaded_id(path) if path else None
+                               for path in self.paths]
+            with transaction.atomic():
+                loaded = self.write(self.articles, replace_ids)
+            bump_version(HIGHLIGHTS)
+        if self.near_duplicates is not None:
+            self.near_duplicates.commit()
+        if self.manifest is not None and (self.paths or self.skipped_paths):
+            for path, article in izip(self.paths, loaded):
+                # A file that wasn't loaded is tried again on the next load
+                if path and article is not None:
+                    self.manifest.record(path, *article)
+            for path in self.skipped_paths:
+                self.manifest.record(path, None)
+            self.manifest.save()
+        self.articles = []
+        self.paths = []
+        self.skipped_paths = []
+
+    def load_topics(self):
+        # Keep the first topic of each name, as Topic.objects.filter(name=..)[0]
+        # used to.
+        self.topics = {}
+        for topic in Topic.objects.order_by('id'):
+            self.topics.setdefault(topic.name, topic)
+
+    def get_topic(self, tua_type):
+        topic = self.topics.get(tua_type)
+        if topic is None:
             # No analysis type loaded--create a dummy type.
             topic = Topic.objects.create(
                 name=tua_type,
                 instructions='',
                 glossary='',
             )
+            self.topics[tua_type] = topic
             ANALYSIS_TYPES[tua_type] = topic
             print("made a dummy topic")
 #           raise ValueError("No TUA type '" + tua_type +
 #                            "' registered. Have you loaded the schemas?")
-        for tua_id, offset_list in tuas.iteritems():
-            offsets.extend(offset_list)
+        return topic
 
-        highlight = HighlightGroup.objects.create(offsets=json.dumps(offsets))
-        try:
-            ArticleHighlight.objects.create(topic=topic,
-                                            highlight=highlight, 
-                                            article=article_obj)
-        except ValidationError as e:
-            print 'error on article #', new_id, 'tua #', tua_id, 'of', tua_type
-            print e
+    def write(self, articles, replace_ids=None):
+        """
+        Writes articles and returns, for each of them, (the id it was loaded
+        as, whether it was written rather than matched to the same text
+        already loaded), or None if it wasn't loaded.
+        replace_ids has, for each article, the id of an article it replaces
+        or None. A replaced article's rows are deleted and the new one takes
+        its id, unless annotators have submitted answers for it.
+        """
+        if replace_ids is None:
+            replace_ids = [None] * len(articles)
+        annotated = annotated_articles(
+            [article_id for article_id in replace_ids
+             if article_id is not None])
+        replaced = [article_id for article_id in replace_ids
+                    if article_id is not None and article_id not in annotated]
+        if replaced:
+            # The highlight groups cascade to the article highlights, spans,
+            # work units and answers, the article to anything else of it
+            HighlightGroup.objects.filter(
+                articlehighlight__article__in=replaced).delete()
+            Article.objects.filter(article_id__in=replaced).delete()
+
+        if self.topics is None:
+            self.load_topics()
+        if self.max_id is None:
+            self.max_id = Article.objects.aggregate(
+                max_id=models.Max('article_id'))['max_id'] or 0
+
+        # The texts of the articles already loaded, by id
+        ids = [int(article['metadata']['article_id']) for article in articles]
+        texts = dict(Article.objects.filter(article_id__in=ids)
+                                    .values_list('article_id', 'text'))
+
+        loaded = []
+        article_objs = []
+        highlights = [] # (article_obj, topic, offsets)
+        for article, replace_id in izip(articles, replace_ids):
+            new_id = int(article['metadata']['article_id'])
+
+            if replace_id in annotated:
+                # Replacing it would delete the annotators' work with it
+                print ("WARNING: not reloading article %d, which has "
+                       "submitted answers. Its file has changed since it "
+                       "was loaded." % replace_id)
+                loaded.append(None)
+                continue
+            elif replace_id is not None:
+                new_id = replace_id
+                texts[new_id] = force_text(article['text'])
+            # Catch duplicate article ids and assign new ids.
+            elif new_id in texts:
+                # Texts come back from the database as unicode
+                if force_text(article['text']) == texts[new_id]:
+                    # we've already loaded this article, so don't process its
+                    # TUAs.
+                    loaded.append((new_id, False))
+                    continue
+                new_id = self.max_id + 1 if self.max_id >= HIGH_ID else HIGH_ID
+                print "NEW ID!", new_id
+            else:
+                texts[new_id] = force_text(article['text'])
+            self.max_id = max(self.max_id, new_id)
+            loaded.append((new_id, True))
+
+            article_obj = Article(
+                article_id=new_id,
+                text=article['text'],
+                date_published=article['metadata']['date_published'],
+                city_published=article['metadata']['city'],
+                state_published=article['metadata']['state'],
+                periodical=article['metadata']['periodical'],
+                periodical_code=int(article['metadata']['periodical_code']),
+                parse_version=article['metadata']['version'],
+                annotators=json.dumps(article['metadata']['annotators']),
+            )
+            article_objs.append(article_obj)
+
+            # Sort the TUAs so that an article gets the same rows whether it
+            # was parsed here or unpickled from a worker process.
+            for tua_type, tuas in sorted(article['tuas'].iteritems()):
+                topic = self.get_topic(tua_type)
+                offsets = []
+                for tua_id, offset_list in sorted(tuas.iteritems()):
+                    offsets.extend(offset_list)
+                highlights.append((article_obj, topic, offsets))
+
+        highlight_groups = []
+        article_highlights = []
+        spans = []
+        work_units = []
+        highlight_ids = reserve_ids(HighlightGroup, len(highlights))
+        article_highlight_ids = reserve_ids(ArticleHighlight, len(highlights))
+        for highlight_id, article_highlight_id, (article_obj, topic, offsets) \
+                in zip(highlight_ids, article_highlight_ids, highlights):
+            highlight = HighlightGroup(id=highlight_id,
+                                       offsets=json.dumps(offsets))
+            highlight_groups.append(highlight)
+            article_highlight = ArticleHighlight(id=article_highlight_id,
+                                                 topic=topic,
+                                                 highlight=highlight,
+                                                 article=article_obj)
+            article_highlights.append(article_highlight)
+            work_units.append(WorkUnit(article_highlight=article_highlight,
+                                       topic=topic))
+            spans.extend(HighlightSpan.from_offsets(offsets,
+                                                    highlight_group=highlight,
+                                                    article=article_obj,
+                                                    topic=topic))
+
+        Article.objects.bulk_create(article_objs)
+        HighlightGroup.objects.bulk_create(highlight_groups)
+        ArticleHighlight.objects.bulk_create(article_highlights)
+        HighlightSpan.objects.bulk_create(spans)
+        WorkUnit.objects.bulk_create(work_units)
+        print 'loaded %d articles' % len(article_objs)
+        return loaded
+
+def annotated_articles(article_ids):
+    """
+    Returns the set of article_ids with submitted answers.
+    """
+    annotated = set()
+    if not article_ids:
+        return annotated
+    lookup = 'highlight_group__articlehighlight__article'
+    for model in (MCSubmittedAnswer, CLSubmittedAnswer, TBSubmittedAnswer,
+                  DTSubmittedAnswer, SubmittedAnswerEvent):
+        answers = model.objects.filter(**{lookup + '__in': article_ids})
+        annotated.update(answers.values_list(lookup, flat=True))
+    return annotated
+
+class LoadManifest(object):
+    """
+    Remembers the mtime, size and content hash of every article file that
+    has been loaded, the article_id it was loaded as and whether the file
+    owns that article (it was written from the file, rather than the file
+    matching an article already loaded), so that re-runs only parse and
+    write new or changed files.
+    The manifest is a JSON file mapping absolute paths to their entries.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        # path -> entry of files that are being loaded
+        self.pending = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                self.entries = json.load(f)
 
-    print 'loading article...'
+    def changed_paths(self, paths):
+        """
+        Yields the paths that are new or changed since they were last loaded.
+        Files are only read when their mtime or size has changed.
+        """
+        for path in paths:
+            key = os.path.abspath(path)
+            stat = os.stat(path)
+            entry = self.entries.get(key)
+            if (entry and entry['mtime'] == stat.st_mtime
+                and entry['size'] == stat.st_size):
+                continue
+
+            with open(path, 'rb') as f:
+                digest = hashlib.sha1(f.read()).hexdigest()
+            if entry and entry['sha1'] == digest:
+                # Touched but not changed
+                entry['mtime'] = stat.st_mtime
+                entry['size'] = stat.st_size
+                continue
+
+            self.pending[key] = {
+                'mtime': stat.st_mtime,
+                'size': stat.st_size,
+                'sha1': digest,
+            }
+            yield path
+
+    def loaded_id(self, path):
+        """
+        Returns the article_id of the article path owns, or None.
+        """
+        entry = self.entries.get(os.path.abspath(path))
+        return entry.get('article_id') if entry and entry.get('owner') \
+            else None
+
+    def record(self, path, article_id, owner=False):
+        key = os.path.abspath(path)
+        entry = self.pending.pop(key)
+        entry['article_id'] = article_id
+        entry['owner'] = owner
+        self.entries[key] = entry
+
+    def save(self):
+        # Write to a temporary file first so that an interrupted load never
+        # leaves a truncated manifest behind.
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.rename(tmp_path, self.path)
+
+def load_article(article):
+    loader = ArticleBatchLoader()
+    loader.add(article)
+    loader.flush()
+
+def parse_article(path):
+    """
+    Parses an article file, or returns None if it's a duplicate.
+    """
+    try:
+        return parse_document(path)
+    except ArticleParseError as e:
+        if e.error_type != ArticleParseError.DUPLICATE_ERROR:
+            raise
+        print "Skipping %s: %s" % (path, e)
+        return None
 
 def load_schema_dir(dirpath):
     for schema_file in os.listdir(dirpath):
@@ -123,11 +390,64 @@ def load_schema_dir(dirpath):
             continue
         load_schema(parse_schema(os.path.join(dirpath, schema_file)))
 
-def load_article_dir(dirpath):
+def article_paths(dirpath):
     for article_file in os.listdir(dirpath):
         if os.path.splitext(article_file)[1] != '.txt':
             continue
-        load_article(parse_document(os.path.join(dirpath, article_file)))
+        yield os.path.join(dirpath, article_file)
+
+def load_article_dir(dirpath, workers=1, batch_size=BATCH_SIZE,
+                     manifest=None, near_duplicates=None):
+    """
+    Parses and loads every article in dirpath.
+    With workers > 1, parse_document runs in a pool of processes while this
+    process stays the only writer. imap keeps the directory order, so the
+    database ends up identical to a serial load.
+    With a LoadManifest, only files that are new or changed since the last
+    load are parsed.
+    Known duplicates, and near duplicates with a NearDuplicateIndex, are
+    skipped.
+    """
+    paths = article_paths(dirpath)
+    if manifest is not None:
+        paths = manifest.changed_paths(paths)
+    paths = list(paths)
+    if manifest is not None:
+        manifest.save()
+        print '%d new or changed articles' % len(paths)
+    pool = None
+    if workers > 1:
+        # Don't share the parent's database connection with the workers
+        for conn in connections.all():
+            conn.close()
+        pool = multiprocessing.Pool(workers)
+        articles = pool.imap(parse_article, paths,
+                             chunksize=max(1, batch_size // workers))
+    else:
+        articles = (parse_article(path) for path in paths)
+
+    loader = ArticleBatchLoader(batch_size, manifest, near_duplicates)
+    try:
+        for path, article in izip(paths, articles):
+            if article is None:
+                loader.skip(path)
+            else:
+                loader.add(article, path)
+        loader.flush()
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+
+def load_article_jsonl(path, batch_size=BATCH_SIZE, near_duplicates=None):
+    """
+    Loads articles from a JSON lines file written by data/parse_document.py,
+    one article at a time.
+    """
+    loader = ArticleBatchLoader(batch_size, near_duplicates=near_duplicates)
+    for article in read_jsonl(path):
+        loader.add(article)
+    loader.flush()
 
 def load_args():
     parser = argparse.ArgumentParser()
@@ -137,11 +457,38 @@ def load_args():
     parser.add_argument(
         '-d', '--article-dir',
         help='The directory holding raw article files for the TUA types')
+    parser.add_argument(
+        '-j', '--article-jsonl',
+        help=('A JSON lines file of parsed articles, as written by '
+              'data/parse_document.py'))
     parser.add_argument(
         '-r', '--reset-db',
         action='store_true',
         default=False,
         help='Reset the database before loading data?')
+    parser.add_argument(
+        '-w', '--workers',
+        type=int,
+        default=1,
+        help='The number of processes used to parse articles')
+    parser.add_argument(
+        '-b', '--batch-size',
+        type=int,
+        default=BATCH_SIZE,
+        help='The number of articles written per transaction')
+    parser.add_argument(
+        '-m', '--manifest',
+        help=('A manifest of the loaded article files. Only files that are '
+              'new or changed since the last load will be loaded'))
+    parser.add_argument(
+        '-n', '--near-duplicates',
+        action='store_true',
+        default=False,
+        help="Skip articles whose text is nearly the same as another's")
+    parser.add_argument(
+        '--near-duplicate-index',
+        help=('A file to keep the near duplicate index in, so that articles '
+              'are also compared with those of earlier loads'))
     return parser.parse_args()
 
 if __name__ == '__main__':
@@ -161,7 +508,28 @@ if __name__ == '__main__':
 
         # run syncdb to recreate tables/indexes
         call_command('syncdb')
+        # Nothing cached before the reset is valid anymore
+        bump_version(SCHEMA)
+        bump_version(HIGHLIGHTS)
+    near_duplicates = None
+    if args.near_duplicates or args.near_duplicate_index:
+        # After a reset none of the indexed articles are loaded anymore
+        near_duplicates = NearDuplicateIndex(args.near_duplicate_index,
+                                             reset=args.reset_db)
     if args.schema_dir:
         load_schema_dir(args.schema_dir)
     if args.article_dir:
-        load_article_dir(args.article_dir)
+        manifest = None
+        if args.manifest:
+            if args.reset_db and os.path.exists(args.manifest):
+                # Nothing in the manifest has been loaded anymore
+                os.remove(args.manifest)
+            manifest = LoadManifest(args.manifest)
+        load_article_dir(args.article_dir, workers=args.workers,
+                         batch_size=args.batch_size, manifest=manifest,
+                         near_duplicates=near_duplicates)
+    if args.article_jsonl:
+        load_article_jsonl(args.article_jsonl, batch_size=args.batch_size,
+                           near_duplicates=near_duplicates)
+    if near_duplicates is not None:
+        near_duplicates.close()
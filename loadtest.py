@@ -0,0 +1,465 @@
+"""
+Load tests the API: seeds a database with a synthetic corpus of schemas,
+articles and submitted answers, replays annotator sessions against the views
+from concurrent clients, and writes the latency and SQL queries of each
+endpoint as a JSON report.
+
+Each annotator session fetches a topic and its tree, clicks through the
+questions of one of its subtopics with next_question, and posts a batch of
+highlight groups with their answers. The clients are threads calling the
+views in process through the Django test client, so the numbers are those of
+the views and the database without a web server in front of them.
+
+The load test runs against a throwaway SQLite database unless another
+database is given with --database-url. SQLite serializes writes, so for
+numbers closer to production give a PostgreSQL database.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from datetime import date, datetime
+
+from django.utils.timezone import utc
+
+from benchmark import git_commit, percentile, progress
+
+# The corpus
+SCHEMAS = 2
+TOPICS = 4
+QUESTIONS = 5
+ANSWERS = 4
+ARTICLES = 200
+WORDS = 600
+TUAS = 3
+ANNOTATORS = 3
+
+# The traffic
+CLIENTS = 8
+SESSIONS = 20
+CLICKS = 5
+POST_SIZE = 5
+
+# The type of each question of a subtopic, in turn
+QUESTION_TYPES = ('mc', 'cl', 'mc', 'tb', 'dt')
+
+WORDS_LIST = ('the protesters marched to city hall where police officers met '
+              'them and a spokesman said the camp would stay open until the '
+              'demands of the movement were heard by the council').split()
+
+# The query count in the Server-Timing header of QueryMetricsMiddleware
+QUERIES_RE = re.compile(r'desc="(\d+) queries"')
+
+def synthetic_schema(index, topics, questions, answers):
+    """
+    Returns a schema as parse_schema returns it, with topics subtopics of
+    questions questions of answers answers. The second question of each
+    subtopic is contingent on the last answer of the first.
+    """
+    from data.parse_schema import Dependency
+    schema = {
+        'title': 'Loadtest %d' % index,
+        'parent': None,
+        'instructions': 'Synthetic schema %d' % index,
+        'glossary': {},
+        'topics': [],
+        'dependencies': [],
+    }
+    for topic_id in range(1, topics + 1):
+        topic = {'id': topic_id, 'name': 'Topic %d' % topic_id,
+                 'questions': []}
+        for question_id in range(1, questions + 1):
+            topic['questions'].append({
+                'question_id': question_id,
+                'question_text': 'Question %d of topic %d' % (question_id,
+                                                             topic_id),
+                'type': QUESTION_TYPES[(question_id - 1) % len(QUESTION_TYPES)],
+                'contingency': question_id == 2,
+                'answers': [{'answer_id': answer_id,
+                             'answer_content': 'Answer %d' % answer_id}
+                            for answer_id in range(1, answers + 1)],
+            })
+        schema['topics'].append(topic)
+        if questions >= 2:
+            schema['dependencies'].append(
+                Dependency(topic_id, 1, answers, 2))
+    return schema
+
+def synthetic_article(article_id, words, tuas, titles, rng):
+    """
+    Returns an article as parse_document returns it, of words words with tuas
+    TUAs of each type in titles.
+    """
+    text = ' '.join(rng.choice(WORDS_LIST) for _ in range(words))
+    article_tuas = {}
+    for title in titles:
+        article_tuas[title] = {}
+        for tua_id in range(1, tuas + 1):
+            start = rng.randrange(max(len(text) - 200, 1))
+            article_tuas[title][tua_id] = [
+                (start, start + rng.randrange(20, 200))]
+    return {
+        'metadata': {
+            'article_id': str(article_id),
+            'date_published': date(2011, 11, 1 + article_id % 28),
+            'city': 'Albany',
+            'state': 'NY',
+            'periodical': 'Loadtest Herald',
+            'periodical_code': '1',
+            'version': '1',
+            'annotators': ['LT'],
+        },
+        'text': text,
+        'tuas': article_tuas,
+    }
+
+def random_answer(question_type, answers, rng):
+    """
+    Returns a random answer to a question of question_type with answers: one
+    of them (mc), some of them (cl), a text (tb) or a date time (dt).
+    """
+    if question_type == 'mc':
+        return rng.choice(answers)
+    if question_type == 'cl':
+        return rng.sample(answers, rng.randint(0, len(answers)))
+    if question_type == 'tb':
+        return ' '.join(rng.sample(WORDS_LIST, 5))
+    return datetime(2011, 11, rng.randint(1, 28), tzinfo=utc)
+
+def seed(args, rng):
+    """
+    Empties the thresher tables and loads the synthetic corpus. Returns what
+    the clients need to know of it.
+    """
+    from django.contrib.auth.models import User
+    from django.core.management import call_command
+    from load_data import ArticleBatchLoader, load_schema
+    from thresher.models import (Article, ArticleHighlight, HighlightGroup,
+                                 Question, Topic, UserProfile,
+                                 SUBMITTED_ANSWER_MODELS)
+    from thresher.serializers import create_submitted_answers
+
+    call_command('syncdb', interactive=False, verbosity=0)
+    HighlightGroup.objects.all().delete()
+    Article.objects.all().delete()
+    Topic.objects.all().delete()
+    User.objects.filter(username__startswith='loadtest').delete()
+
+    progress('loading %d schemas' % args.schemas)
+    titles = []
+    for index in range(args.schemas):
+        schema = synthetic_schema(index, args.topics, args.questions,
+                                  args.answers)
+        load_schema(schema)
+        titles.append(schema['title'])
+
+    progress('loading %d articles' % args.articles)
+    loader = ArticleBatchLoader()
+    for article_id in range(args.articles):
+        loader.add(synthetic_article(article_id, args.words, args.tuas, titles,
+                                     rng))
+    loader.flush()
+
+    users = []
+    for index in range(max(args.clients, args.annotators)):
+        user = User.objects.create_user('loadtest%d' % index)
+        users.append(UserProfile.objects.create(
+            user=user, experience_score=0, accuracy_score=0))
+
+    questions = list(Question.objects.filter(topic__parent__name__in=titles)
+                                     .prefetch_related('answers')
+                                     .select_related('topic'))
+    topic_questions = defaultdict(list)
+    for question in questions:
+        topic_questions[question.topic.parent_id].append(question)
+
+    # Each annotator answers every question of one subtopic of each loaded
+    # highlight group
+    progress('answering as %d annotators' % args.annotators)
+    models = dict((model.__name__[:2].lower(), model)
+                  for model in SUBMITTED_ANSWER_MODELS)
+    submitted = []
+    for highlight, topic in ArticleHighlight.objects.values_list(
+            'highlight_id', 'topic_id'):
+        highlight_group = HighlightGroup(id=highlight)
+        for user in users[:args.annotators]:
+            subtopic = rng.choice(topic_questions[topic]).topic_id
+            for question in topic_questions[topic]:
+                if question.topic_id != subtopic:
+                    continue
+                answer = random_answer(question.type,
+                                       list(question.answers.all()), rng)
+                submitted.append((highlight_group, {
+                    'class': models[question.type],
+                    'type': question.type,
+                    'data': {'question': question, 'answer': answer,
+                             'user_submitted': user},
+                }))
+    create_submitted_answers(submitted)
+
+    corpus = {
+        'topics': sorted(topic_questions),
+        'users': [user.pk for user in users],
+        # The first question of each subtopic, by root topic
+        'first_questions': defaultdict(list),
+        # The questions and their answers, by root topic
+        'questions': defaultdict(list),
+    }
+    for topic, questions in topic_questions.items():
+        for question in questions:
+            answer_ids = [choice.pk for choice in question.answers.all()]
+            corpus['questions'][topic].append(
+                (question.pk, question.type, answer_ids))
+            if question.question_id == 1:
+                corpus['first_questions'][topic].append(question.pk)
+    progress('seeded %d submitted answers' % len(submitted))
+    return corpus
+
+def client_class():
+    from django.test import Client
+
+    class LoadTestClient(Client):
+        # The test client re-raises the exception of a view through a signal
+        # handler all the clients share, so another thread's client could
+        # raise it. Respond 500 instead, as a server would.
+        def store_exc_info(self, **kwargs):
+            pass
+
+    return LoadTestClient
+
+class Annotator(threading.Thread):
+    """
+    A client replaying annotator sessions. Every request is recorded in
+    results as (endpoint, status, seconds, queries).
+    """
+    def __init__(self, user, corpus, args, results, seed):
+        super(Annotator, self).__init__()
+        self.user = user
+        self.corpus = corpus
+        self.args = args
+        self.results = results
+        self.rng = random.Random(seed)
+
+    def request(self, endpoint, method, url, data=None):
+        start = time.time()
+        if method == 'POST':
+            response = self.client.post(url, json.dumps(data),
+                                        content_type='application/json')
+        else:
+            response = self.client.get(url)
+        seconds = time.time() - start
+        match = QUERIES_RE.search(response.get('Server-Timing', ''))
+        self.results.append((endpoint, response.status_code, seconds,
+                             int(match.group(1)) if match else None))
+        return response
+
+    def click_through(self, question):
+        """
+        Follows next_question from question for up to CLICKS answers.
+        """
+        response = self.request('GET /question/ID', 'GET',
+                                '/api/question/%d' % question)
+        for _ in range(self.args.clicks):
+            if response.status_code != 200:
+                return
+            data = json.loads(response.content)
+            if not data.get('id') or not data['answers']:
+                return
+            answer = self.rng.choice(data['answers'])
+            response = self.request('GET /question/ID/ANS', 'GET',
+                                    '/api/question/%d/%d' % (
+                                        data['id'], answer['answer_id']))
+
+    def highlight_groups(self, topic):
+        groups = []
+        for _ in range(self.args.post_size):
+            start = self.rng.randrange(self.args.words)
+            questions = []
+            for question, question_type, answers in \
+                    self.corpus['questions'][topic]:
+                answer = random_answer(question_type, answers, self.rng)
+                if question_type == 'dt':
+                    answer = answer.isoformat()
+                questions.append({'question': question, 'answer': answer,
+                                  'user': self.user})
+            groups.append({'offsets': [[start, start + 50]],
+                           'questions': questions})
+        return groups
+
+    def session(self):
+        topic = self.rng.choice(self.corpus['topics'])
+        self.request('GET /topics/ID', 'GET', '/api/topics/%d' % topic)
+        self.request('GET /topics/ID/tree', 'GET',
+                     '/api/topics/%d/tree' % topic)
+        self.click_through(self.rng.choice(
+            self.corpus['first_questions'][topic]))
+        self.request('POST /highlight_groups', 'POST',
+                     '/api/highlight_groups/', self.highlight_groups(topic))
+
+    def run(self):
+        from django.db import connections
+        self.client = client_class()()
+        try:
+            for _ in range(self.args.sessions):
+                self.session()
+        finally:
+            for connection in connections.all():
+                connection.close()
+
+def summarize(results, seconds):
+    """
+    Returns the latency and query percentiles of each endpoint.
+    """
+    by_endpoint = defaultdict(list)
+    for result in results:
+        by_endpoint[result[0]].append(result[1:])
+    summary = {}
+    for endpoint, requests in sorted(by_endpoint.items()):
+        times = sorted(seconds for _, seconds, _ in requests)
+        queries = sorted(count for _, _, count in requests if count is not None)
+        errors = defaultdict(int)
+        for status, _, _ in requests:
+            if status not in (200, 201):
+                errors[str(status)] += 1
+        summary[endpoint] = {
+            'count': len(requests),
+            'errors': dict(errors),
+            'requests_per_second': len(requests) / seconds,
+            'p50_seconds': percentile(times, 50),
+            'p95_seconds': percentile(times, 95),
+            'p99_seconds': percentile(times, 99),
+            'max_seconds': times[-1],
+        }
+        if queries:
+            summary[endpoint].update({
+                'mean_queries': sum(queries) / float(len(queries)),
+                'p50_queries': percentile(queries, 50),
+                'p95_queries': percentile(queries, 95),
+                'p99_queries': percentile(queries, 99),
+                'max_queries': queries[-1],
+            })
+    return summary
+
+def run(args):
+    # The loader prints progress, which isn't part of the report
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    tmp_dir = tempfile.mkdtemp(prefix='thresher_loadtest_')
+    try:
+        # Before anything loads the settings, which read it
+        if not args.database_url:
+            os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(
+                tmp_dir, 'loadtest.db')
+        else:
+            os.environ['DATABASE_URL'] = args.database_url
+        from django.db import connection
+
+
+        rng = random.Random(args.seed)
+        corpus = seed(args, rng)
+        # The clients open their own connections
+        connection.close()
+        # Every request of a load test is slow; the report has their numbers
+        logging.getLogger('thresher.metrics').setLevel(logging.ERROR)
+
+        progress('replaying %d sessions from each of %d clients' % (
+            args.sessions, args.clients))
+        results = []
+        clients = [Annotator(corpus['users'][i], corpus, args, results,
+                             rng.random())
+                   for i in range(args.clients)]
+        start = time.time()
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        seconds = time.time() - start
+
+        report = {
+            'commit': git_commit(),
+            'date': datetime.utcnow().isoformat(),
+            'python': platform.python_version(),
+            'database': connection.vendor,
+            'corpus': dict((name, getattr(args, name)) for name in (
+                'schemas', 'topics', 'questions', 'answers', 'articles',
+                'words', 'tuas', 'annotators')),
+            'traffic': dict((name, getattr(args, name)) for name in (
+                'clients', 'sessions', 'clicks', 'post_size', 'seed')),
+            'seconds': seconds,
+            'requests': len(results),
+            'endpoints': summarize(results, seconds),
+        }
+        return report
+    finally:
+        sys.stdout = stdout
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def print_summary(report):
+    progress('%-24s %6s %6s %9s %9s %9s %8s %8s' % (
+        'endpoint', 'count', 'errors', 'p50 ms', 'p95 ms', 'p99 ms',
+        'p50 sql', 'p99 sql'))
+    for endpoint, result in sorted(report['endpoints'].items()):
+        progress('%-24s %6d %6d %9.1f %9.1f %9.1f %8s %8s' % (
+            endpoint, result['count'], sum(result['errors'].values()),
+            result['p50_seconds'] * 1000, result['p95_seconds'] * 1000,
+            result['p99_seconds'] * 1000, result.get('p50_queries', '-'),
+            result.get('p99_queries', '-')))
+    progress('%d requests in %.1fs' % (report['requests'], report['seconds']))
+
+def loadtest_args():
+    parser = argparse.ArgumentParser(
+        description='Load tests the API with a synthetic corpus')
+    parser.add_argument(
+        '-o', '--output',
+        help='The file to write the JSON report to (default: standard output)')
+    for name, default, help in (
+            ('schemas', SCHEMAS, 'The number of schemas'),
+            ('topics', TOPICS, 'The number of subtopics of each schema'),
+            ('questions', QUESTIONS, 'The number of questions of each subtopic'),
+            ('answers', ANSWERS, 'The number of answers of each question'),
+            ('articles', ARTICLES, 'The number of articles'),
+            ('words', WORDS, 'The number of words of each article'),
+            ('tuas', TUAS, 'The number of TUAs of each schema in each article'),
+            ('annotators', ANNOTATORS,
+             'The number of users who answered each loaded highlight group'),
+            ('clients', CLIENTS, 'The number of concurrent clients'),
+            ('sessions', SESSIONS,
+             'The number of annotator sessions of each client'),
+            ('clicks', CLICKS,
+             'The most next_question clicks of each session'),
+            ('post-size', POST_SIZE,
+             'The number of highlight groups posted by each session')):
+        parser.add_argument('--' + name, type=int, default=default,
+                            help='%s (default: %d)' % (help, default))
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=0,
+        help='The random seed of the corpus and the traffic (default: 0)')
+    parser.add_argument(
+        '--database-url',
+        help=('The database to load test. Its thresher tables are emptied! '
+              '(default: a temporary SQLite database)'))
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE',
+                          'thresher_backend.settings')
+    args = loadtest_args()
+    report = run(args)
+    print_summary(report)
+    content = json.dumps(report, indent=1, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(content + '\n')
+    else:
+        print content
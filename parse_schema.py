@@ -3,12 +3,26 @@
 
 import json
 
+from django.core.exceptions import ValidationError
+from django.db import transaction
+
+from thresher import flow
+from thresher.bulk import reserve_ids
+from thresher.caching import SCHEMA, bump_version
 from thresher.models import *
 
 ###### EXCEPTIONS ######
 
 ########################
 
+def schema_changed():
+    """
+    Invalidates the cached topic trees and question flows, which still hold
+    the old schema.
+    """
+    bump_version(SCHEMA)
+    flow.reset()
+
 class TopicsSchemaParser(object):
     """
     Parses a json schema of topics and questions and populates the database
@@ -30,6 +44,16 @@ class TopicsSchemaParser(object):
         if not isinstance(topic_obj, Topic):
             raise ValueError("schema must be an instance of Topic model")
         self.dep = dependencies
+        # The rows of the schema, built in memory and written by write()
+        self.topics = []
+        self.questions = []
+        self.answers = []
+        # The questions of each topic, by topic id
+        self.topic_questions = {}
+        # The questions with each (topic order, question_id)
+        self.questions_by_id = {}
+        # The answers of each question, by question id
+        self.question_answers = {}
 
     def load_answers(self, answers, question):
         """
@@ -37,13 +61,15 @@ class TopicsSchemaParser(object):
         answers: A list of answers 
         question: The question that answers belongs to
         """
+        question_answers = self.question_answers.setdefault(question.id, [])
         # find the corresponding topic and question ids
         for answer_args in answers:
             # create the next question reference, it will be rewritten in
             # load_next_question
-            answer_args['question'] = question
-            # Create the answer in the database
-            answer = Answer.objects.create(**answer_args)
+            answer_args = dict(answer_args, question=question)
+            answer = Answer(**answer_args)
+            self.answers.append(answer)
+            question_answers.append(answer)
 
     def load_questions(self, questions, topic):
         """
@@ -53,30 +79,72 @@ class TopicsSchemaParser(object):
         """
         for question_args in questions:
             # Create the topic
-            question_args['topic'] = topic
+            question_args = dict(question_args, topic=topic)
             # Store the answers for later
             answers = question_args.pop('answers')
             # Create the Question
-            question = Question.objects.create(**question_args)
+            question = Question(id=self.question_ids.pop(0), **question_args)
+            self.questions.append(question)
+            self.topic_questions.setdefault(topic.id, []).append(question)
+            self.questions_by_id.setdefault(
+                (topic.order, question.question_id), []).append(question)
             # Load the Question's answers
             self.load_answers(answers, question)
 
     def load_topics(self):
         """
         Loads all the topics, their questions and their answers.
+        The whole schema is built in memory and written in one transaction.
+        """
+        # Invalidate even if the load fails, as the caller may already have
+        # changed topic_obj's subtopics
+        try:
+            self.check_unique_topics()
+            with transaction.atomic():
+                # Reserve the ids that the questions and answers point to
+                self.topic_ids = reserve_ids(Topic, len(self.schema_json))
+                self.question_ids = reserve_ids(Question, sum(
+                    len(topic_args['questions'])
+                    for topic_args in self.schema_json))
+
+                for topic_args in self.schema_json:
+                    topic_args = dict(topic_args)
+                    # Get the questions to add them later
+                    questions = topic_args.pop('questions')
+                    # Change id to order
+                    topic_args['order'] = topic_args.pop('id')
+                    # Set reference to parent
+                    topic_args['parent'] = self.topic_obj
+                    # Create the topic with the values in topic_args
+                    topic = Topic(id=self.topic_ids.pop(0), **topic_args)
+                    self.topics.append(topic)
+                    self.load_questions(questions, topic)
+                self.load_next_question()
+                self.load_dependencies()
+                self.write()
+        finally:
+            schema_changed()
+
+    def check_unique_topics(self):
+        """
+        Raises a ValidationError if two subtopics of the schema, or a subtopic
+        of the schema and an existing subtopic of topic_obj, have the same
+        name. Topic.save checks this for one topic at a time.
         """
+        names = set(Topic.objects.filter(parent=self.topic_obj)
+                                 .values_list('name', flat=True))
         for topic_args in self.schema_json:
-            # Get the questions to add them later
-            questions = topic_args.pop('questions')
-            # Change id to order
-            topic_args['order'] = topic_args.pop('id')
-            # Set reference to parent
-            topic_args['parent'] = self.topic_obj
-            # Create the topic with the values in topic_args
-            topic = Topic.objects.create(**topic_args)
-            self.load_questions(questions, topic)
-        self.load_next_question()
-        self.load_dependencies()
+            if topic_args['name'] in names:
+                raise ValidationError('Subtopics need to be unique.')
+            names.add(topic_args['name'])
+
+    def write(self):
+        """
+        Writes the topics, questions and answers built in memory.
+        """
+        Topic.objects.bulk_create(self.topics)
+        Question.objects.bulk_create(self.questions)
+        Answer.objects.bulk_create(self.answers)
 
     def load_next_question(self):
         """
@@ -85,11 +153,11 @@ class TopicsSchemaParser(object):
         signals the end. Also populates each mandatory question 
         with a default next question.
         """
-        topics = Topic.objects.filter(parent=self.topic_obj)
-        for topic in topics:
-            questions = Question.objects.filter(topic=topic, 
-                                                contingency=False) \
-                                        .order_by('question_id')
+        for topic in self.topics:
+            questions = sorted((question for question
+                                in self.topic_questions.get(topic.id, [])
+                                if not question.contingency),
+                               key=lambda question: question.question_id)
             for i in range(len(questions) - 1):
                 self.write_answers(questions[i], questions[i + 1])
 
@@ -102,42 +170,36 @@ class TopicsSchemaParser(object):
                        default
         """
         curr_question.default_next = next_question
-        curr_question.save()
-        answers = Answer.objects.filter(question=curr_question)
-        for answer in answers:
+        for answer in self.question_answers[curr_question.id]:
             answer.next_question = next_question
-            answer.save()
+
+    def find_question(self, topic_order, question_id):
+        """
+        Returns the first question with question_id in the topics with
+        topic_order.
+        """
+        return self.questions_by_id.get((topic_order, question_id), [])[0]
 
     def load_dependencies(self):
         """
         Loads dependencies into targeted answers.
         """
-        topics = Topic.objects.filter(parent=self.topic_obj)
         for dep in self.dep:
-            topic = topics.filter(order=dep.topic)
-            question = Question.objects.filter(topic=topic, 
-                                               question_id=dep.question)[0]
-            answers = Answer.objects.filter(
-                question=question)
-            next_question = Question.objects.filter(
-                topic=topic, question_id=dep.next_question)[0]
-            next_question_answers = Answer.objects.filter(
-                question=next_question)
-            
+            question = self.find_question(dep.topic, dep.question)
+            answers = self.question_answers[question.id]
+            next_question = self.find_question(dep.topic, dep.next_question)
+            next_question_answers = self.question_answers[next_question.id]
+
             next_question.default_next = question.default_next
-            next_question.save()
 
             # First we populate the contingency question's answers with the
             # default next answer
             for answer in next_question_answers:
                 answer.next_question = next_question.default_next
-                answer.save()
 
             # Now we point the current question's answer to the next question
-            if dep.answer == '*':
-                answers = answers
-            else:
-                answers = answers.filter(answer_id=dep.answer)
+            if dep.answer != '*':
+                answers = [answer for answer in answers
+                           if answer.answer_id == dep.answer]
             for answer in answers:
                 answer.next_question = next_question
-                answer.save()
@@ -1,2 +1,4 @@
 #!/bin/bash
+# syncdb recreates the cache table; drop it so no stale entries survive
+(echo "DROP TABLE IF EXISTS thresher_cache;" | python manage.py dbshell)
 (python manage.py sqlclear thresher | python manage.py dbshell) && python manage.py syncdb
@@ -0,0 +1,370 @@
+# Agreement between annotators, per article and topic.
+#
+# The coders of a highlight group are the users who submitted answers to it,
+# or, when it has none, the annotators of the loaded annotation
+# (Article.annotators). Each coder is credited with the spans of every group
+# they coded. For each (article, topic) we compute, over the characters of
+# the article,
+#   - overlap: the characters every annotator highlighted over those any of
+#     them did, and
+#   - highlight_alpha: Krippendorff's alpha of highlighted / not highlighted,
+# and, over the multiple choice and checklist answers,
+#   - answer_alpha: Krippendorff's alpha of the answers to each question (and
+#     of each checklist choice being checked or not).
+# Each user's answers are also counted as agreeing or not with the other
+# annotators' most common answer, for the user's accuracy_score.
+# Scores are stored in AgreementScore and only recomputed for units with
+# highlight groups or submitted answers newer than the last computation.
+# Articles are locked while they're computed, so concurrent computations of
+# an article take turns instead of both replacing its scores and counts.
+
+import json
+from collections import defaultdict
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+
+from models import (Article, Answer, ArticleHighlight, AgreementScore,
+                    CLSubmittedAnswer, DTSubmittedAnswer, HighlightSpan,
+                    MCSubmittedAnswer, SubmittedAnswerEvent,
+                    TBSubmittedAnswer, UserAgreement, update_user_counters)
+
+# Articles computed per batch of queries
+BATCH_SIZE = 500
+
+def krippendorff_alpha(counts):
+    """
+    Returns Krippendorff's alpha for nominal data, or None when it isn't
+    defined (fewer than two values, or only one value used).
+    counts[u, v] is the number of annotators who gave unit u value v.
+    """
+    counts = np.asarray(counts, dtype=float)
+    if counts.ndim != 2:
+        return None
+    pairable = counts.sum(axis=1)
+    counts = counts[pairable >= 2]
+    pairable = pairable[pairable >= 2]
+    if not len(counts):
+        return None
+
+    # The coincidences of values within each unit, weighted by the number of
+    # pairs the unit's annotators make
+    weighted = counts / (pairable - 1)[:, np.newaxis]
+    coincidences = weighted.T.dot(counts) - np.diag(weighted.sum(axis=0))
+    totals = coincidences.sum(axis=1)
+    n = totals.sum()
+    observed = coincidences.sum() - np.trace(coincidences)
+    expected = n * n - (totals ** 2).sum()
+    if expected <= 0:
+        return None
+    return float(1 - (n - 1) * observed / expected)
+
+def coverage(coders, starts, ends, length):
+    """
+    Returns, for each character of a text of length characters, the number of
+    coders that highlighted it. coders, starts and ends are arrays with one
+    entry per span, coders numbered from 0. A coder's overlapping spans count
+    once.
+    """
+    starts = np.clip(starts, 0, length)
+    ends = np.clip(ends, 0, length)
+    deltas = np.zeros((coders.max() + 1, length + 1), dtype=int)
+    np.add.at(deltas, (coders, starts), 1)
+    np.add.at(deltas, (coders, ends), -1)
+    return (deltas.cumsum(axis=1)[:, :length] > 0).sum(axis=0)
+
+def highlight_agreement(spans, length):
+    """
+    Returns (coders, overlap, alpha) of a list of (coder, start, end) spans
+    over a text of length characters.
+    """
+    coder_ids = sorted(set(coder for coder, _, _ in spans))
+    if len(coder_ids) < 2 or length <= 0:
+        return len(coder_ids), None, None
+
+    index = dict((coder, i) for i, coder in enumerate(coder_ids))
+    spans = np.array([(index[coder], start, end)
+                      for coder, start, end in spans], dtype=int)
+    highlighted = coverage(spans[:, 0], spans[:, 1], spans[:, 2], length)
+
+    anyone = np.count_nonzero(highlighted)
+    overlap = None
+    if anyone:
+        overlap = np.count_nonzero(highlighted == len(coder_ids)) / float(anyone)
+    alpha = krippendorff_alpha(np.column_stack(
+        (len(coder_ids) - highlighted, highlighted)))
+    return len(coder_ids), overlap, alpha
+
+def answer_units(answers, checklist_choices):
+    """
+    Returns {unit: {value: set of coders}} of a list of (coder, question type,
+    question, answer) answers: each multiple choice question is a unit valued
+    by the answer chosen, and each choice of a checklist question a unit
+    valued by whether it was checked. checklist_choices maps a checklist
+    question to its Answer ids.
+    """
+    units = defaultdict(lambda: defaultdict(set))
+    for coder, question_type, question, answer in answers:
+        if question_type == 'mc':
+            units[(question, None)][answer].add(coder)
+        else:
+            for choice in checklist_choices.get(question, ()):
+                units[(question, choice)][choice in answer].add(coder)
+    return units
+
+def answer_agreement(units):
+    """
+    Returns Krippendorff's alpha of the answer_units units.
+    """
+    values = sorted(set(value for unit in units.values() for value in unit),
+                    key=repr)
+    if not values:
+        return None
+    index = dict((value, i) for i, value in enumerate(values))
+    counts = np.zeros((len(units), len(values)), dtype=int)
+    for row, unit in enumerate(units.values()):
+        for value, coders in unit.items():
+            counts[row, index[value]] = len(coders)
+    return krippendorff_alpha(counts)
+
+def user_agreement(units):
+    """
+    Returns {coder: [checked, agreed]} of the answer_units units: the units
+    a coder answered along with other coders, and those where the coder gave
+    a value the most others gave.
+    """
+    counts = defaultdict(lambda: [0, 0])
+    for unit in units.values():
+        coders = set().union(*unit.values())
+        if len(coders) < 2:
+            continue
+        for coder in coders:
+            others = dict((value, len(value_coders - set([coder])))
+                          for value, value_coders in unit.items())
+            most = max(others.values())
+            counts[coder][0] += 1
+            if any(others[value] == most for value, value_coders
+                   in unit.items() if coder in value_coders):
+                counts[coder][1] += 1
+    return counts
+
+def group_answers(article_ids):
+    """
+    Returns {highlight group id: [(user, type, question, answer)]} of the mc
+    and cl answers, and {highlight group id: set of users} of every answer,
+    for the highlight groups of article_ids.
+    """
+    lookup = 'highlight_group__articlehighlight__article__in'
+    coders = defaultdict(set)
+    answers = defaultdict(list)
+    if settings.CONSOLIDATED_ANSWERS:
+        rows = SubmittedAnswerEvent.objects.filter(**{lookup: article_ids}) \
+            .values_list('highlight_group_id', 'user_submitted_id', 'type',
+                         'question_id', 'answer_choice_id', 'answer_choices')
+        for group, user, answer_type, question, choice, choices in rows:
+            coders[group].add(user)
+            if answer_type == 'mc':
+                answers[group].append((user, 'mc', question, choice))
+            elif answer_type == 'cl':
+                answers[group].append((user, 'cl', question,
+                                       frozenset(json.loads(choices))))
+        return answers, coders
+
+    columns = ['highlight_group_id', 'user_submitted_id', 'question_id']
+    for group, user, question, answer in MCSubmittedAnswer.objects.filter(
+            **{lookup: article_ids}).values_list(*(columns + ['answer_id'])):
+        coders[group].add(user)
+        answers[group].append((user, 'mc', question, answer))
+    for model in (TBSubmittedAnswer, DTSubmittedAnswer):
+        for group, user in model.objects.filter(**{lookup: article_ids}) \
+                                        .values_list(*columns[:2]):
+            coders[group].add(user)
+
+    checklists = defaultdict(set)
+    rows = CLSubmittedAnswer.answer.through.objects.filter(**{
+        'clsubmittedanswer__' + lookup: article_ids}).values_list(
+            'clsubmittedanswer__highlight_group_id',
+            'clsubmittedanswer__user_submitted_id',
+            'clsubmittedanswer__question_id', 'answer_id')
+    for group, user, question, choice in rows:
+        checklists[(group, user, question)].add(choice)
+    # Checklist answers with nothing checked have no through rows
+    rows = CLSubmittedAnswer.objects.filter(**{lookup: article_ids}) \
+                                    .values_list(*columns)
+    for group, user, question in rows:
+        coders[group].add(user)
+        answers[group].append((user, 'cl', question, frozenset(
+            checklists.get((group, user, question), ()))))
+    return answers, coders
+
+def answer_models():
+    """
+    Returns (name, model) of the tables the submitted answers are read from.
+    """
+    if settings.CONSOLIDATED_ANSWERS:
+        return [('events', SubmittedAnswerEvent)]
+    return [('mc', MCSubmittedAnswer), ('cl', CLSubmittedAnswer),
+            ('tb', TBSubmittedAnswer), ('dt', DTSubmittedAnswer)]
+
+def last_answers(article_ids=None):
+    """
+    Returns {(article, topic): {answer table: newest answer id}} of the
+    answers to the article highlights of article_ids, or of every article.
+    """
+    lookup = 'highlight_group__articlehighlight__'
+    latest = defaultdict(dict)
+    for name, model in answer_models():
+        answers = model.objects.all()
+        if article_ids is not None:
+            answers = answers.filter(**{lookup + 'article__in': article_ids})
+        rows = answers.values_list(lookup + 'article', lookup + 'topic') \
+                      .annotate(last=Max('id')).order_by()
+        for article, topic, last in rows:
+            latest[(article, topic)][name] = last
+    return latest
+
+def compute_scores(article_ids, checklist_choices):
+    """
+    Returns the unsaved AgreementScores and UserAgreements of every
+    (article, topic) with highlights in article_ids.
+    """
+    # Read before the answers, so that an answer submitted meanwhile leaves
+    # the scores stale rather than counted as included
+    answer_ids = last_answers(article_ids)
+    lengths = {}
+    loaded_coders = {}
+    for article, length, annotators in Article.objects.filter(
+            article_id__in=article_ids).extra(
+                select={'length': 'LENGTH(text)'}).values_list(
+                    'article_id', 'length', 'annotators'):
+        lengths[article] = length
+        # The loaded annotation is one coder, whoever its annotators were
+        loaded_coders[article] = 'annotators:%s' % ','.join(
+            sorted(json.loads(annotators or '[]')))
+    answers, coders = group_answers(article_ids)
+
+    def group_coders(article, group):
+        return coders.get(group) or [loaded_coders.get(article)]
+
+    spans = defaultdict(list)
+    rows = HighlightSpan.objects.filter(article__in=article_ids).values_list(
+        'article_id', 'topic_id', 'highlight_group_id', 'start', 'end')
+    for article, topic, group, start, end in rows:
+        for coder in group_coders(article, group):
+            spans[(article, topic)].append((coder, start, end))
+
+    unit_answers = defaultdict(list)
+    unit_coders = defaultdict(set)
+    last_highlights = {}
+    rows = ArticleHighlight.objects.filter(article__in=article_ids) \
+        .values_list('article_id', 'topic_id', 'highlight_id')
+    for article, topic, group in rows:
+        unit_answers[(article, topic)].extend(answers.get(group, ()))
+        unit_coders[(article, topic)].update(group_coders(article, group))
+        last_highlights[(article, topic)] = max(
+            group, last_highlights.get((article, topic), 0))
+
+    scores = []
+    user_agreements = []
+    for (article, topic), last_highlight in last_highlights.items():
+        _, overlap, highlight_alpha = highlight_agreement(
+            spans[(article, topic)], lengths.get(article, 0))
+        units = answer_units(unit_answers[(article, topic)], checklist_choices)
+        scores.append(AgreementScore(
+            article_id=article, topic_id=topic,
+            coders=len(unit_coders[(article, topic)]),
+            overlap=overlap, highlight_alpha=highlight_alpha,
+            answer_alpha=answer_agreement(units),
+            last_highlight_id=last_highlight,
+            last_answer_ids=json.dumps(answer_ids.get((article, topic),
+                                                      {}))))
+        for user, (checked, agreed) in user_agreement(units).items():
+            user_agreements.append(UserAgreement(
+                article_id=article, topic_id=topic, user_id=user,
+                answers_checked=checked, answers_agreed=agreed))
+    return scores, user_agreements
+
+def stale_articles(article_ids=None):
+    """
+    Returns the ids of the articles, of article_ids if given, with highlight
+    groups or submitted answers newer than their agreement scores.
+    """
+    highlights = ArticleHighlight.objects.all()
+    scores = AgreementScore.objects.all()
+    if article_ids is not None:
+        highlights = highlights.filter(article__in=article_ids)
+        scores = scores.filter(article__in=article_ids)
+    computed = {}
+    computed_answers = {}
+    for article, topic, last, answer_ids in scores.values_list(
+            'article_id', 'topic_id', 'last_highlight_id', 'last_answer_ids'):
+        computed[(article, topic)] = last
+        computed_answers[(article, topic)] = json.loads(answer_ids)
+    latest = highlights.values_list('article_id', 'topic_id') \
+                       .annotate(last=Max('highlight')).order_by()
+    stale = set(article for article, topic, last in latest
+                if computed.get((article, topic), 0) < last)
+    for (article, topic), answer_ids in last_answers(article_ids).items():
+        done = computed_answers.get((article, topic), {})
+        if any(last > done.get(name, 0) for name, last in answer_ids.items()):
+            stale.add(article)
+    return sorted(stale)
+
+def update_agreement(article_ids=None, recompute=False):
+    """
+    Computes the agreement scores of the articles with new highlight groups
+    or submitted answers, or of every article with recompute, of article_ids
+    if given. Returns the number of articles computed.
+    """
+    if recompute:
+        articles = ArticleHighlight.objects.order_by('article') \
+            .values_list('article_id', flat=True).distinct()
+        if article_ids is not None:
+            articles = articles.filter(article__in=article_ids)
+        articles = list(articles)
+    else:
+        articles = stale_articles(article_ids)
+
+    checklist_choices = defaultdict(list)
+    for question, answer in Answer.objects.filter(question__type='cl') \
+                                          .values_list('question_id', 'id'):
+        checklist_choices[question].append(answer)
+
+    computed = 0
+    for i in range(0, len(articles), BATCH_SIZE):
+        batch = articles[i:i + BATCH_SIZE]
+        with transaction.atomic():
+            # Lock the batch's articles, then check them again: another
+            # computation of them may have committed while this one waited
+            list(Article.objects.select_for_update().filter(
+                article_id__in=batch).order_by('article_id')
+                .values_list('article_id', flat=True))
+            if not recompute:
+                batch = stale_articles(batch)
+                if not batch:
+                    continue
+            computed += len(batch)
+            scores, user_agreements = compute_scores(batch, checklist_choices)
+
+            # Replace the batch's counts in the users' running counters
+            deltas = defaultdict(lambda: defaultdict(int))
+            old = UserAgreement.objects.filter(article__in=batch)
+            for user, checked, agreed in old.values_list(
+                    'user_id', 'answers_checked', 'answers_agreed'):
+                deltas[user]['answers_checked'] -= checked
+                deltas[user]['answers_agreed'] -= agreed
+            for user_agreement in user_agreements:
+                counts = deltas[user_agreement.user_id]
+                counts['answers_checked'] += user_agreement.answers_checked
+                counts['answers_agreed'] += user_agreement.answers_agreed
+            old.delete()
+            UserAgreement.objects.bulk_create(user_agreements)
+            update_user_counters(dict(
+                (user, counts) for user, counts in deltas.items()
+                if any(counts.values())))
+
+            AgreementScore.objects.filter(article__in=batch).delete()
+            AgreementScore.objects.bulk_create(scores)
+    return computed
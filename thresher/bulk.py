@@ -0,0 +1,25 @@
+from django.db import connection
+from django.db.models import Max
+
+def reserve_ids(model, count):
+    """
+    Reserves count primary keys for model.
+    bulk_create doesn't hand back the ids of the rows it inserts, so rows that
+    other rows point to get their ids assigned up front instead.
+    On PostgreSQL the ids come from the table's sequence and are safe to use
+    concurrently. Other backends get the ids following the current maximum,
+    so the rows have to be inserted in the same transaction before ids are
+    reserved again.
+    """
+    if count <= 0:
+        return []
+
+    if connection.vendor == 'postgresql':
+        cursor = connection.cursor()
+        cursor.execute("SELECT nextval(pg_get_serial_sequence(%s, %s)) "
+                       "FROM generate_series(1, %s)",
+                       [model._meta.db_table, model._meta.pk.column, count])
+        return sorted(row[0] for row in cursor.fetchall())
+
+    max_id = model.objects.aggregate(max_id=Max('pk'))['max_id'] or 0
+    return range(max_id + 1, max_id + count + 1)
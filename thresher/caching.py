@@ -0,0 +1,46 @@
+# Versioned cache keys for payloads that are expensive to build.
+#
+# Instead of deleting cached entries when the data behind them changes, every
+# payload key includes the current version token of the data it was built
+# from. Bumping a version makes all older entries unreachable; they are
+# evicted by the cache backend in due course.
+
+import hashlib
+import uuid
+
+from django.core.cache import cache
+
+# The topics, questions and answers loaded by TopicsSchemaParser
+SCHEMA = 'schema'
+# Articles, highlight groups and their submitted answers
+HIGHLIGHTS = 'highlights'
+
+def version_key(name):
+    return 'thresher:version:%s' % name
+
+def get_version(name):
+    """
+    Returns the current version token for name.
+    A missing token (never set, or evicted) is replaced by a fresh one, so
+    entries built before the eviction can't be served again.
+    """
+    key = version_key(name)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid.uuid4().hex, timeout=None)
+        version = cache.get(key)
+    return version
+
+def bump_version(name):
+    """
+    Invalidates everything cached under the current version of name.
+    """
+    cache.set(version_key(name), uuid.uuid4().hex, timeout=None)
+
+def topic_tree_key(topic_id, variant=''):
+    """
+    variant tells apart different payloads of the same topic.
+    """
+    return 'thresher:topic_tree:%s:%s:%s:%s' % (
+        topic_id, hashlib.md5(variant.encode('utf-8')).hexdigest(),
+        get_version(SCHEMA), get_version(HIGHLIGHTS))
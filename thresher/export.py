@@ -0,0 +1,140 @@
+# Exports the submitted answers, with their highlight groups and articles, as
+# JSON lines. Rows are streamed from the database as they are written, so an
+# export of any size runs in constant memory.
+
+import json
+import uuid
+from itertools import groupby
+from operator import itemgetter
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, transaction
+
+from models import (CLSubmittedAnswer, MCSubmittedAnswer, TBSubmittedAnswer,
+                    DTSubmittedAnswer, SubmittedAnswerEvent)
+
+# Rows fetched from the database at a time
+CHUNK_SIZE = 2000
+
+# The question type of each submitted answer model
+ANSWER_TYPES = (
+    ('cl', CLSubmittedAnswer),
+    ('mc', MCSubmittedAnswer),
+    ('tb', TBSubmittedAnswer),
+    ('dt', DTSubmittedAnswer),
+)
+
+# The columns of an exported row, read through each submitted answer
+COLUMNS = (
+    ('id', 'id'),
+    ('highlight_group', 'highlight_group_id'),
+    ('question', 'question_id'),
+    ('user', 'user_submitted_id'),
+    ('offsets', 'highlight_group__offsets'),
+    ('article', 'highlight_group__articlehighlight__article_id'),
+    ('topic', 'highlight_group__articlehighlight__topic_id'),
+)
+
+def stream_rows(queryset):
+    """
+    Yields the rows of a values_list queryset without holding the whole
+    result in memory. Must be called in a transaction.
+    psycopg2 fetches the whole result of a query on execute, so on PostgreSQL
+    the rows are read through a server-side (named) cursor instead.
+    """
+    if connection.vendor != 'postgresql':
+        for row in queryset.iterator():
+            yield row
+        return
+
+    sql, params = queryset.query.sql_with_params()
+    connection.ensure_connection()
+    cursor = connection.connection.cursor(name='export_%s' % uuid.uuid4().hex)
+    cursor.itersize = CHUNK_SIZE
+    try:
+        cursor.execute(sql, params)
+        for row in cursor:
+            yield row
+    finally:
+        cursor.close()
+
+def checklist_rows(rows):
+    """
+    Adds the chosen answers to each row of checklist answers, which must be
+    ordered by id. The choices are read in the same order alongside, instead
+    of with a query per row.
+    """
+    Choice = CLSubmittedAnswer.answer.through
+    choices = groupby(stream_rows(
+        Choice.objects.order_by('clsubmittedanswer', 'answer')
+                      .values_list('clsubmittedanswer_id', 'answer_id')),
+        key=itemgetter(0))
+    current = next(choices, None)
+    for row in rows:
+        while current is not None and current[0] < row[0]:
+            current = next(choices, None)
+        answer = []
+        if current is not None and current[0] == row[0]:
+            answer = [choice for _, choice in current[1]]
+            current = next(choices, None)
+        yield row + (answer,)
+
+# The value column of a SubmittedAnswerEvent of each type
+EVENT_VALUES = (
+    ('mc', 'answer_choice_id'),
+    ('cl', 'answer_choices'),
+    ('tb', 'answer_text'),
+    ('dt', 'answer_datetime'),
+)
+
+def typed_rows(lookups):
+    """
+    Yields (answer type, row) for the answers in the table of each type, each
+    row ending with the answer.
+    """
+    for answer_type, model in ANSWER_TYPES:
+        if model is CLSubmittedAnswer:
+            rows = checklist_rows(stream_rows(
+                model.objects.order_by('id').values_list(*lookups)))
+        else:
+            rows = stream_rows(model.objects.order_by('id')
+                               .values_list(*(lookups + ['answer'])))
+        for row in rows:
+            yield answer_type, row
+
+def event_rows(lookups):
+    """
+    Yields (answer type, row) for the answers in the SubmittedAnswerEvent
+    table, each row ending with the answer.
+    """
+    columns = [column for _, column in EVENT_VALUES]
+    value_index = dict((answer_type, len(lookups) + 1 + i)
+                       for i, (answer_type, _) in enumerate(EVENT_VALUES))
+    rows = stream_rows(SubmittedAnswerEvent.objects.order_by('id')
+                       .values_list(*(lookups + ['type'] + columns)))
+    for row in rows:
+        answer_type = row[len(lookups)]
+        answer = row[value_index[answer_type]]
+        if answer_type == 'cl':
+            answer = json.loads(answer)
+        yield answer_type, row[:len(lookups)] + (answer,)
+
+def export_answers():
+    """
+    Yields one JSON line per submitted answer.
+    """
+    encoder = DjangoJSONEncoder()
+    names = [name for name, _ in COLUMNS] + ['answer']
+    lookups = [lookup for _, lookup in COLUMNS]
+    if settings.CONSOLIDATED_ANSWERS:
+        rows = event_rows
+    else:
+        rows = typed_rows
+    with transaction.atomic():
+        for answer_type, row in rows(lookups):
+            record = dict(zip(names, row))
+            record['type'] = answer_type
+            if record['offsets']:
+                record['offsets'] = json.loads(record['offsets'])
+            yield encoder.encode(record) + '\n'
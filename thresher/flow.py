@@ -0,0 +1,86 @@
+# The question flow of the loaded schemas, compiled into process memory.
+#
+# Navigating from a question and an answer to the next question is the call
+# the annotation front-end makes most. The graph below answers it without
+# touching the database. It is built on first use and rebuilt once the schema
+# version (see caching.py) changes, which TopicsSchemaParser.load_topics and
+# every save or delete of a topic, question or answer bump.
+
+import threading
+import time
+
+from caching import SCHEMA, get_version
+from models import Question
+from serializers import QuestionSerializer
+
+# Seconds between checks of the schema version. A schema loaded by another
+# process is picked up at most this long after it was written.
+VERSION_CHECK_INTERVAL = 5
+
+class FlowGraph(object):
+    """
+    The serialized questions and, for each question, the question each of
+    its answers leads to.
+    """
+    def __init__(self, version):
+        self.version = version
+        # Question id -> serialized question
+        self.questions = {}
+        # (Question id, answer_id) -> id of the next question or None
+        self.next = {}
+        # What next_question returns when an answer ends the flow
+        self.end = QuestionSerializer(None).data
+
+        questions = Question.objects.prefetch_related('answers')
+        for question, data in zip(questions,
+                                  QuestionSerializer(questions, many=True).data):
+            self.questions[question.id] = data
+            for answer in question.answers.all():
+                self.next[(question.id, answer.answer_id)] = \
+                    answer.next_question_id
+
+    def question(self, question_id):
+        """
+        Returns the serialized question, or None if there is no such question.
+        """
+        return self.questions.get(question_id)
+
+    def next_question(self, question_id, answer_id):
+        """
+        Returns the serialized question that answer_id of question_id leads
+        to, or None if there is no such answer.
+        """
+        key = (question_id, answer_id)
+        if key not in self.next:
+            return None
+        next_id = self.next[key]
+        if next_id is None:
+            return self.end
+        return self.questions[next_id]
+
+_graph = None
+_checked = 0
+_lock = threading.Lock()
+
+def get_graph():
+    """
+    Returns the flow graph of the current schema version.
+    """
+    global _graph, _checked
+    now = time.time()
+    if _graph is not None and now - _checked < VERSION_CHECK_INTERVAL:
+        return _graph
+
+    with _lock:
+        version = get_version(SCHEMA)
+        if _graph is None or _graph.version != version:
+            _graph = FlowGraph(version)
+        _checked = now
+    return _graph
+
+def reset():
+    """
+    Drops this process's graph, so the next request rebuilds it.
+    """
+    global _graph
+    _graph = None
@@ -0,0 +1,26 @@
+from django.conf import settings
+from django.core.management import call_command
+from django.db import connections
+from django.db.models.signals import post_syncdb
+
+import thresher.models
+
+def create_cache_table(sender, db, verbosity=1, **kwargs):
+    """
+    Creates the table of the database cache, which syncdb doesn't manage, if
+    it isn't there yet.
+    """
+    cache = settings.CACHES['default']
+    if cache['BACKEND'] != 'django.core.cache.backends.db.DatabaseCache':
+        return
+    connection = connections[db]
+    # The test runner creates the cache table of the test database itself
+    if connection.settings_dict['NAME'] == \
+            connection.creation._get_test_db_name():
+        return
+    if cache['LOCATION'] in connection.introspection.table_names():
+        return
+    call_command('createcachetable', cache['LOCATION'], database=db,
+                 verbosity=verbosity)
+
+post_syncdb.connect(create_cache_table, sender=thresher.models)
@@ -0,0 +1,18 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from thresher.agreement import update_agreement
+
+class Command(BaseCommand):
+    help = ('Computes the inter-annotator agreement of the articles with '
+            'highlight groups or answers added since it was last computed')
+    option_list = BaseCommand.option_list + (
+        make_option('--all', action='store_true', default=False,
+                    dest='recompute',
+                    help='Recompute the agreement of every article'),
+    )
+
+    def handle(self, *args, **options):
+        count = update_agreement(recompute=options['recompute'])
+        self.stdout.write('Computed the agreement of %d articles' % count)
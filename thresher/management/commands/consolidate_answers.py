@@ -0,0 +1,53 @@
+import json
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from thresher.export import CHUNK_SIZE, EVENT_VALUES, typed_rows
+from thresher.models import SubmittedAnswerEvent
+
+class Command(BaseCommand):
+    help = ('Copies the submitted answers of every type into the '
+            'SubmittedAnswerEvent table, for CONSOLIDATED_ANSWERS')
+    option_list = BaseCommand.option_list + (
+        make_option('--replace', action='store_true', default=False,
+                    help='Delete the answers already in the table first'),
+    )
+
+    def handle(self, *args, **options):
+        value_columns = dict(EVENT_VALUES)
+        count = 0
+        with transaction.atomic():
+            if SubmittedAnswerEvent.objects.exists():
+                if not options['replace']:
+                    raise CommandError('The SubmittedAnswerEvent table is not '
+                                       'empty. Use --replace to copy the '
+                                       'answers again.')
+                SubmittedAnswerEvent.objects.all().delete()
+
+            # The answers are read type by type in the order
+            # HighlightGroup.questions lists them, so ordering the events by
+            # id lists them the same way.
+            events = []
+            lookups = ['id', 'highlight_group_id', 'question_id',
+                       'user_submitted_id']
+            for answer_type, row in typed_rows(lookups):
+                _, group_id, question_id, user_id, answer = row
+                if answer_type == 'cl':
+                    answer = json.dumps(answer)
+                events.append(SubmittedAnswerEvent(**{
+                    'highlight_group_id': group_id,
+                    'question_id': question_id,
+                    'user_submitted_id': user_id,
+                    'type': answer_type,
+                    value_columns[answer_type]: answer,
+                }))
+                if len(events) == CHUNK_SIZE:
+                    SubmittedAnswerEvent.objects.bulk_create(events)
+                    count += len(events)
+                    events = []
+            SubmittedAnswerEvent.objects.bulk_create(events)
+            count += len(events)
+
+        self.stdout.write('Copied %d submitted answers' % count)
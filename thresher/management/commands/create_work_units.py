@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from thresher.export import CHUNK_SIZE, stream_rows
+from thresher.models import ArticleHighlight, WorkUnit
+
+class Command(BaseCommand):
+    help = 'Creates the work units of the article highlights that have none'
+
+    def handle(self, *args, **options):
+        count = 0
+        with transaction.atomic():
+            rows = stream_rows(ArticleHighlight.objects
+                               .filter(work_unit=None).order_by('id')
+                               .values_list('id', 'topic_id'))
+            units = []
+            for article_highlight_id, topic_id in rows:
+                units.append(WorkUnit(article_highlight_id=article_highlight_id,
+                                      topic_id=topic_id))
+                if len(units) == CHUNK_SIZE:
+                    WorkUnit.objects.bulk_create(units)
+                    count += len(units)
+                    units = []
+            WorkUnit.objects.bulk_create(units)
+            count += len(units)
+
+        self.stdout.write('Created %d work units' % count)
@@ -0,0 +1,22 @@
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from thresher.export import export_answers
+
+class Command(BaseCommand):
+    help = 'Writes every submitted answer as a line of JSON'
+    option_list = BaseCommand.option_list + (
+        make_option('-o', '--output',
+                    help='The file to write to (default: standard output)'),
+    )
+
+    def handle(self, *args, **options):
+        out = open(options['output'], 'w') if options['output'] else sys.stdout
+        try:
+            for line in export_answers():
+                out.write(line)
+        finally:
+            if out is not sys.stdout:
+                out.close()
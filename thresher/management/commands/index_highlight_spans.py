@@ -0,0 +1,31 @@
+import json
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from thresher.export import CHUNK_SIZE, stream_rows
+from thresher.models import ArticleHighlight, HighlightSpan
+
+class Command(BaseCommand):
+    help = ('Rebuilds the HighlightSpan rows of every article highlight from '
+            'its highlight group\'s offsets')
+
+    def handle(self, *args, **options):
+        count = 0
+        with transaction.atomic():
+            HighlightSpan.objects.all().delete()
+            rows = stream_rows(ArticleHighlight.objects.order_by('id').values_list(
+                'highlight_id', 'article_id', 'topic_id', 'highlight__offsets'))
+            spans = []
+            for group_id, article_id, topic_id, offsets in rows:
+                spans.extend(HighlightSpan.from_offsets(
+                    json.loads(offsets or '[]'), highlight_group_id=group_id,
+                    article_id=article_id, topic_id=topic_id))
+                if len(spans) >= CHUNK_SIZE:
+                    HighlightSpan.objects.bulk_create(spans)
+                    count += len(spans)
+                    spans = []
+            HighlightSpan.objects.bulk_create(spans)
+            count += len(spans)
+
+        self.stdout.write('Indexed %d highlight spans' % count)
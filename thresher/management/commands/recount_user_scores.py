@@ -0,0 +1,39 @@
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Sum
+
+from thresher.models import (SubmittedAnswerEvent, SUBMITTED_ANSWER_MODELS,
+                             UserAgreement, UserCounters, UserProfile,
+                             update_user_counters)
+
+class Command(BaseCommand):
+    help = ('Recounts the counters of every user from the submitted answers '
+            'and the computed agreement, and updates their scores')
+
+    def handle(self, *args, **options):
+        totals = defaultdict(lambda: defaultdict(int))
+        if settings.CONSOLIDATED_ANSWERS:
+            models = (SubmittedAnswerEvent,)
+        else:
+            models = SUBMITTED_ANSWER_MODELS
+        for model in models:
+            rows = model.objects.values_list('user_submitted') \
+                                .annotate(count=Count('id')).order_by()
+            for user, count in rows:
+                totals[user]['answers_submitted'] += count
+        rows = UserAgreement.objects.values('user') \
+            .annotate(checked=Sum('answers_checked'),
+                      agreed=Sum('answers_agreed')).order_by()
+        for row in rows:
+            totals[row['user']]['answers_checked'] += row['checked']
+            totals[row['user']]['answers_agreed'] += row['agreed']
+
+        with transaction.atomic():
+            UserCounters.objects.all().delete()
+            UserProfile.objects.update(experience_score=0, accuracy_score=0)
+            update_user_counters(totals)
+
+        self.stdout.write('Recounted the scores of %d users' % len(totals))
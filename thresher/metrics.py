@@ -0,0 +1,194 @@
+# Per view request metrics: SQL queries, database time, serializer time,
+# total time and response size.
+#
+# QueryMetricsMiddleware records every request. The totals are exposed in the
+# Prometheus text format at /api/metrics, each response carries a
+# Server-Timing header with its own numbers, and requests over
+# METRICS_SLOW_QUERIES queries or METRICS_SLOW_SECONDS seconds are logged.
+# The totals are kept per process, so each web worker reports its own.
+# Queries are counted and timed by a cursor wrapper that keeps no SQL, so
+# production requests don't accumulate connection.queries as under DEBUG.
+
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.util import CursorWrapper
+
+logger = logging.getLogger(__name__)
+
+# What each view's totals are named in the Prometheus output, in order
+COUNTERS = (
+    ('requests', 'Requests served'),
+    ('queries', 'SQL queries run'),
+    ('db_seconds', 'Seconds spent running SQL queries'),
+    ('serializer_seconds', 'Seconds spent serializing responses'),
+    ('seconds', 'Seconds spent serving requests'),
+    ('response_bytes', 'Bytes of response content'),
+)
+
+class Metrics(object):
+    """
+    The totals of the requests to each (view, method).
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.totals = {}
+
+    def record(self, view, method, **values):
+        with self.lock:
+            totals = self.totals.setdefault((view, method),
+                                            dict.fromkeys(dict(COUNTERS), 0))
+            totals['requests'] += 1
+            for name, value in values.items():
+                totals[name] += value
+
+    def render(self):
+        """
+        Returns the totals in the Prometheus text exposition format.
+        """
+        with self.lock:
+            totals = sorted(self.totals.items())
+        lines = []
+        for name, description in COUNTERS:
+            metric = 'thresher_%s_total' % name
+            lines.append('# HELP %s %s' % (metric, description))
+            lines.append('# TYPE %s counter' % metric)
+            for (view, method), values in totals:
+                lines.append('%s{view="%s",method="%s"} %s' % (
+                    metric, escape_label(view), escape_label(method),
+                    repr(values[name])))
+        return '\n'.join(lines) + '\n'
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"') \
+                .replace('\n', '\\n')
+
+METRICS = Metrics()
+
+# The queries, database time and serializer time of the request the current
+# thread is serving
+_local = threading.local()
+
+def add_serializer_time(seconds):
+    if getattr(_local, 'serializer_seconds', None) is not None:
+        _local.serializer_seconds += seconds
+
+class CountingCursor(object):
+    """
+    Counts and times the queries of a cursor for the current request.
+    """
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def timed(self, method, *args):
+        start = time.time()
+        try:
+            return getattr(self.cursor, method)(*args)
+        finally:
+            if getattr(_local, 'queries', None) is not None:
+                _local.queries += 1
+                _local.db_seconds += time.time() - start
+
+    def execute(self, sql, params=None):
+        return self.timed('execute', sql, params)
+
+    def executemany(self, sql, param_list):
+        return self.timed('executemany', sql, param_list)
+
+    def callproc(self, procname, params=None):
+        return self.timed('callproc', procname, params)
+
+def counting_cursors(connection, debug):
+    """
+    Returns a make_debug_cursor for connection that counts its queries, and
+    also logs them in connection.queries if debug.
+    """
+    def make_cursor(cursor):
+        if debug:
+            cursor = type(connection).make_debug_cursor(connection, cursor)
+        else:
+            cursor = CursorWrapper(cursor, connection)
+        return CountingCursor(cursor)
+    return make_cursor
+
+def view_name(view_func):
+    """
+    Returns the name a view is reported as: its name, and for viewsets the
+    kind of route (List or Instance).
+    """
+    name = getattr(view_func, '__name__', None) or repr(view_func)
+    suffix = getattr(view_func, 'suffix', None)
+    return '%s %s' % (name, suffix) if suffix else name
+
+class QueryMetricsMiddleware(object):
+    """
+    Records the metrics of each request. Should be the first middleware, so
+    that its timing includes the others.
+    """
+    def process_request(self, request):
+        request._metrics_start = time.time()
+        request._metrics_view = 'unresolved'
+        # Count the queries of every connection, even without DEBUG
+        request._metrics_cursors = {}
+        for connection in connections.all():
+            use_debug_cursor = connection.use_debug_cursor
+            request._metrics_cursors[connection.alias] = use_debug_cursor
+            connection.make_debug_cursor = counting_cursors(
+                connection, use_debug_cursor or (use_debug_cursor is None
+                                                 and settings.DEBUG))
+            connection.use_debug_cursor = True
+        _local.queries = 0
+        _local.db_seconds = 0.0
+        _local.serializer_seconds = 0.0
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request._metrics_view = view_name(view_func)
+
+    def process_response(self, request, response):
+        if not hasattr(request, '_metrics_start'):
+            return response
+        seconds = time.time() - request._metrics_start
+
+        for connection in connections.all():
+            if connection.alias in request._metrics_cursors:
+                connection.use_debug_cursor = \
+                    request._metrics_cursors[connection.alias]
+                del connection.make_debug_cursor
+        queries = _local.queries or 0
+        db_seconds = _local.db_seconds or 0.0
+        _local.queries = None
+        _local.db_seconds = None
+        serializer_seconds = _local.serializer_seconds or 0.0
+        _local.serializer_seconds = None
+
+        # Streamed content is produced after the response leaves here
+        size = 0 if response.streaming else len(response.content)
+
+        METRICS.record(request._metrics_view, request.method,
+                       queries=queries, db_seconds=db_seconds,
+                       serializer_seconds=serializer_seconds,
+                       seconds=seconds, response_bytes=size)
+
+        response['Server-Timing'] = ', '.join([
+            'db;dur=%.1f;desc="%d queries"' % (db_seconds * 1000, queries),
+            'serializer;dur=%.1f' % (serializer_seconds * 1000),
+            'total;dur=%.1f' % (seconds * 1000),
+        ])
+
+        if (queries > settings.METRICS_SLOW_QUERIES
+                or seconds > settings.METRICS_SLOW_SECONDS):
+            logger.warning('Slow request %s %s (%s): %d queries, %.3fs in '
+                           'the database, %.3fs serializing, %.3fs total, '
+                           '%d bytes', request.method, request.get_full_path(),
+                           request._metrics_view, queries, db_seconds,
+                           serializer_seconds, seconds, size)
+        return response
@@ -1,6 +1,13 @@
-from django.db import models
+import json
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import connection, models, transaction
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
+from django.db.models.signals import post_delete, post_save
+
+from caching import SCHEMA, bump_version
 
 # User doing the annotating - uses OneToOneFields to add attributes to django.contrib.auth.User
 class UserProfile(models.Model):
@@ -14,6 +21,62 @@ class UserProfile(models.Model):
     def __unicode__(self):
         return "User %s" % self.user
 
+# The running counts the scores of a UserProfile are computed from, updated as
+# answers are submitted and as their agreement is computed
+class UserCounters(models.Model):
+    profile = models.OneToOneField(UserProfile, primary_key=True,
+                                   related_name="counters")
+
+    # The answers the user submitted
+    answers_submitted = models.IntegerField(default=0)
+
+    # The answers that other annotators also gave an answer for, and those
+    # that matched what most of the others answered
+    answers_checked = models.IntegerField(default=0)
+    answers_agreed = models.IntegerField(default=0)
+
+    def scores(self):
+        """
+        Returns (experience_score, accuracy_score): the thousands of answers
+        submitted (up to what the column holds), and the share of checked
+        answers agreed on.
+        """
+        experience = min(self.answers_submitted, 99999) / 1000.0
+        accuracy = 0.0
+        if self.answers_checked:
+            accuracy = float(self.answers_agreed) / self.answers_checked
+        return (Decimal('%.3f' % experience), Decimal('%.3f' % accuracy))
+
+def update_user_counters(deltas):
+    """
+    Adds deltas, {UserProfile id: {counter name: amount}}, to the users'
+    counters and updates their scores, two queries per user who has counters
+    already.
+    """
+    if not deltas:
+        return
+    with transaction.atomic():
+        counters = UserCounters.objects.select_for_update() \
+                                       .in_bulk(deltas.keys())
+        missing = [profile_id for profile_id in deltas
+                   if profile_id not in counters]
+        if missing:
+            # A concurrent first submission may be creating the same rows,
+            # which get_or_create waits for and reads instead of failing
+            for profile_id in missing:
+                UserCounters.objects.get_or_create(profile_id=profile_id)
+            counters.update(UserCounters.objects.select_for_update()
+                                                .in_bulk(missing))
+        for profile_id, amounts in deltas.items():
+            user_counters = counters[profile_id]
+            for name, amount in amounts.items():
+                setattr(user_counters, name,
+                        getattr(user_counters, name) + amount)
+            user_counters.save()
+            experience, accuracy = user_counters.scores()
+            UserProfile.objects.filter(pk=profile_id).update(
+                experience_score=experience, accuracy_score=accuracy)
+
 class Client(models.Model):
     name = models.CharField(max_length=100)
     topic = models.ForeignKey("Topic", on_delete=models.CASCADE, 
@@ -148,6 +211,13 @@ class HighlightGroup(models.Model):
         """
         A property to access all the submitted answers in this highlight group
         """
+        # Answers attached by prefetch_submitted_answers
+        if hasattr(self, '_submitted_answers'):
+            return self._submitted_answers
+
+        if settings.CONSOLIDATED_ANSWERS:
+            return list(self.answer_events.order_by('pk'))
+
         # The CL answers
         cl_answers = list(CLSubmittedAnswer.objects.filter(highlight_group=self))
         # The MC answers
@@ -171,6 +241,143 @@ class ArticleHighlight(models.Model):
         return ("Highlights %s in Article %d") % (self.highlight.offsets, 
                                                   self.article.article_id)
 
+# An article highlight as a unit of work handed out to annotators, with the
+# number of annotators who have completed it
+class WorkUnit(models.Model):
+    article_highlight = models.OneToOneField(ArticleHighlight,
+                                             primary_key=True,
+                                             related_name="work_unit",
+                                             on_delete=models.CASCADE)
+    topic = models.ForeignKey(Topic, related_name="work_units",
+                              on_delete=models.CASCADE)
+    completed = models.IntegerField(default=0)
+
+    class Meta:
+        index_together = (("topic", "completed"),)
+
+# A work unit handed to an annotator until expires_at
+class TaskLease(models.Model):
+    unit = models.ForeignKey(WorkUnit, related_name="leases",
+                             on_delete=models.CASCADE)
+    user = models.ForeignKey(UserProfile, related_name="leases",
+                             on_delete=models.CASCADE)
+    leased_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField()
+    completed_at = models.DateTimeField(null=True)
+
+    class Meta:
+        index_together = (("unit", "expires_at"), ("user", "expires_at"))
+
+# A single highlighted span of a highlight group in an article, so the
+# database can find highlights by position. Offsets are half-open:
+# [start, end).
+class HighlightSpan(models.Model):
+    highlight_group = models.ForeignKey(HighlightGroup, related_name="spans",
+                                        on_delete=models.CASCADE)
+    article = models.ForeignKey(Article, related_name="highlight_spans",
+                                on_delete=models.CASCADE)
+    topic = models.ForeignKey(Topic, related_name="highlight_spans",
+                              on_delete=models.CASCADE)
+    start = models.IntegerField()
+    end = models.IntegerField()
+
+    class Meta:
+        index_together = (("article", "start", "end"),)
+
+    @classmethod
+    def from_offsets(cls, offsets, **kwargs):
+        """
+        Returns the unsaved spans of a list of (start, end) offsets.
+        """
+        return [cls(start=start, end=end, **kwargs) for start, end in offsets]
+
+def overlapping_highlights(article_id, start, end):
+    """
+    Returns the ArticleHighlights of article_id that highlight any character
+    in [start, end).
+    """
+    return ArticleHighlight.objects.filter(
+        highlight__spans__article=article_id,
+        highlight__spans__start__lt=end,
+        highlight__spans__end__gt=start).distinct()
+
+def highlight_overlaps(article_ids, topic_id=None):
+    """
+    Returns (topic_id, highlight_group_id, highlight_group_id, characters)
+    for every pair of highlight groups of the same topic in article_ids whose
+    spans overlap, with the number of characters they both highlight,
+    optionally of a single topic.
+    """
+    if not article_ids:
+        return []
+    qn = connection.ops.quote_name
+    sql = """
+        SELECT a.{topic}, a.{group}, b.{group},
+               SUM(CASE WHEN a.{end} < b.{end} THEN a.{end} ELSE b.{end} END -
+                   CASE WHEN a.{start} > b.{start} THEN a.{start}
+                        ELSE b.{start} END)
+        FROM {table} a JOIN {table} b
+          ON a.{article} = b.{article} AND a.{topic} = b.{topic}
+         AND a.{group} < b.{group}
+         AND a.{start} < b.{end} AND b.{start} < a.{end}
+        WHERE a.{article} IN ({ids}) {topic_filter}
+        GROUP BY a.{topic}, a.{group}, b.{group}
+        ORDER BY a.{topic}, a.{group}, b.{group}
+    """.format(table=qn(HighlightSpan._meta.db_table),
+               article=qn('article_id'), topic=qn('topic_id'),
+               group=qn('highlight_group_id'), start=qn('start'),
+               end=qn('end'), ids=', '.join(['%s'] * len(article_ids)),
+               topic_filter='' if topic_id is None
+                            else 'AND a.%s = %%s' % qn('topic_id'))
+    params = list(article_ids)
+    if topic_id is not None:
+        params.append(topic_id)
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    return cursor.fetchall()
+
+# The agreement between the annotators of an article's highlights for a
+# topic, computed by agreement.update_agreement
+class AgreementScore(models.Model):
+    article = models.ForeignKey(Article, related_name="agreement_scores",
+                                on_delete=models.CASCADE)
+    topic = models.ForeignKey(Topic, related_name="agreement_scores",
+                              on_delete=models.CASCADE)
+
+    # The number of annotators
+    coders = models.IntegerField()
+
+    # The characters all annotators highlighted over those any of them did
+    overlap = models.FloatField(null=True)
+
+    # Krippendorff's alpha of the highlighted characters and of the answers
+    # (null when there is nothing to disagree on)
+    highlight_alpha = models.FloatField(null=True)
+    answer_alpha = models.FloatField(null=True)
+
+    # The newest highlight group the scores include, and the newest
+    # submitted answer of each answer table, as a JSON object
+    last_highlight_id = models.IntegerField()
+    last_answer_ids = models.TextField(default='{}')
+
+    computed_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ("article", "topic")
+
+# A user's answers to an article's questions for a topic that other
+# annotators answered too, and how many of them matched the others' most
+# common answer. Added to UserCounters as they're computed.
+class UserAgreement(models.Model):
+    article = models.ForeignKey(Article, related_name="user_agreements",
+                                on_delete=models.CASCADE)
+    topic = models.ForeignKey(Topic, related_name="user_agreements",
+                              on_delete=models.CASCADE)
+    user = models.ForeignKey(UserProfile, related_name="agreements",
+                             on_delete=models.CASCADE)
+    answers_checked = models.IntegerField()
+    answers_agreed = models.IntegerField()
+
 # A submitted answer to a question
 # This is an abstract class which is subclassed to represent
 # specifi types of answers (MC, CL, TB, ...)
@@ -245,3 +452,117 @@ class DTSubmittedAnswer(SubmittedAnswer):
     
     # The submitted date time answer
     answer = models.DateTimeField()
+
+# A submitted answer of any type, in a single table with a column for the
+# value of each type. Used instead of the tables above when
+# settings.CONSOLIDATED_ANSWERS is on.
+class SubmittedAnswerEvent(models.Model):
+    # The highlight group this answer is part of
+    highlight_group = models.ForeignKey(HighlightGroup,
+                                        related_name="answer_events")
+
+    # The question this answer is for
+    question = models.ForeignKey(Question)
+
+    # The user who submitted this answer
+    user_submitted = models.ForeignKey(UserProfile,
+                                       related_name="submitted_answers")
+
+    # The type of the question answered
+    type = models.CharField(max_length=2,
+                            choices=Question.QUESTION_TYPE_CHOICES)
+
+    # The answer chosen (mc)
+    answer_choice = models.ForeignKey(Answer, null=True)
+
+    # The answers checked, as a JSON list of Answer ids (cl)
+    answer_choices = models.TextField(null=True)
+
+    # The text of the answer (tb)
+    answer_text = models.TextField(null=True)
+
+    # The submitted date time answer (dt)
+    answer_datetime = models.DateTimeField(null=True)
+
+    class Meta:
+        index_together = (("highlight_group", "question"),)
+
+    @classmethod
+    def build(cls, answer_type, answer, **kwargs):
+        """
+        Returns an unsaved answer of answer_type. answer is the value the
+        submitted answer model of the type takes (a list of Answers for cl).
+        """
+        if answer_type == 'mc':
+            kwargs['answer_choice'] = answer
+        elif answer_type == 'cl':
+            kwargs['answer_choices'] = json.dumps(
+                [choice.pk for choice in answer])
+        elif answer_type == 'tb':
+            kwargs['answer_text'] = answer
+        else:
+            kwargs['answer_datetime'] = answer
+        return cls(type=answer_type, **kwargs)
+
+    @property
+    def value(self):
+        """
+        The answer: an Answer id (mc), a list of Answer ids (cl), a text (tb)
+        or a date time (dt).
+        """
+        if self.type == 'mc':
+            return self.answer_choice_id
+        if self.type == 'cl':
+            return json.loads(self.answer_choices)
+        if self.type == 'tb':
+            return self.answer_text
+        return self.answer_datetime
+
+# The submitted answer models, in the order HighlightGroup.questions lists them
+SUBMITTED_ANSWER_MODELS = (CLSubmittedAnswer, MCSubmittedAnswer,
+                           TBSubmittedAnswer, DTSubmittedAnswer)
+
+def prefetch_submitted_answers(highlight_groups):
+    """
+    Loads the submitted answers of all highlight_groups with one query per
+    answer type (plus one for the checklist answers), or a single query with
+    CONSOLIDATED_ANSWERS, and attaches them, so that HighlightGroup.questions
+    doesn't query for each group.
+    """
+    groups = {}
+    for highlight_group in highlight_groups:
+        highlight_group._submitted_answers = []
+        groups.setdefault(highlight_group.pk, []).append(highlight_group)
+    if not groups:
+        return
+
+    if settings.CONSOLIDATED_ANSWERS:
+        events = SubmittedAnswerEvent.objects.filter(
+            highlight_group__in=groups.keys()).order_by('pk')
+        for event in events:
+            for highlight_group in groups[event.highlight_group_id]:
+                highlight_group._submitted_answers.append(event)
+        return
+
+    for model in SUBMITTED_ANSWER_MODELS:
+        answers = model.objects.filter(highlight_group__in=groups.keys()) \
+                               .select_related('question') \
+                               .order_by('pk')
+        if model is CLSubmittedAnswer:
+            answers = answers.prefetch_related('answer')
+        for answer in answers:
+            for highlight_group in groups[answer.highlight_group_id]:
+                highlight_group._submitted_answers.append(answer)
+
+def schema_changed(sender, **kwargs):
+    """
+    Invalidates the cached topic trees and question flows when a topic,
+    question or answer is saved or deleted one at a time, as through the
+    admin. Bulk writes send no signals; the schema loader invalidates
+    itself.
+    """
+    bump_version(SCHEMA)
+
+for model in (Topic, Question, Answer):
+    post_save.connect(schema_changed, sender=model)
+    post_delete.connect(schema_changed, sender=model)
@@ -0,0 +1,82 @@
+# Keyset (cursor) pagination.
+#
+# Page numbers make the database skip every row before the page (OFFSET), so
+# deep pages get slower the deeper they are. A keyset page instead starts
+# after the last key of the previous page, which the index finds directly.
+
+import base64
+import binascii
+
+from django.http import Http404
+from rest_framework import serializers
+from rest_framework.pagination import BasePaginationSerializer
+from rest_framework.templatetags.rest_framework import replace_query_param
+
+def encode_cursor(position):
+    return base64.urlsafe_b64encode('p=%d' % position)
+
+def decode_cursor(cursor):
+    """
+    Returns the position encoded in cursor, or raises Http404 if cursor is
+    not one of ours.
+    """
+    try:
+        key, position = base64.urlsafe_b64decode(str(cursor)).split('=', 1)
+        if key != 'p':
+            raise ValueError(key)
+        return int(position)
+    except (TypeError, ValueError, UnicodeEncodeError, binascii.Error):
+        raise Http404('Invalid cursor')
+
+class KeysetPage(object):
+    """
+    A page of objects and the cursor of the page after it, if there is one.
+    """
+    def __init__(self, object_list, next_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+
+class NextCursorField(serializers.Field):
+    """
+    Field that returns a link to the next page of keyset paginated results.
+    """
+    cursor_field = 'cursor'
+
+    def to_representation(self, value):
+        if value.next_cursor is None:
+            return None
+        request = self.context.get('request')
+        url = request and request.build_absolute_uri() or ''
+        return replace_query_param(url, self.cursor_field, value.next_cursor)
+
+class KeysetPaginationSerializer(BasePaginationSerializer):
+    next = NextCursorField(source='*')
+
+class KeysetPaginationMixin(object):
+    """
+    Paginates a viewset by an integer key, unique and indexed, instead of by
+    page number. The page size is configured the same way as for page number
+    pagination (paginate_by, paginate_by_param, max_paginate_by).
+    """
+    pagination_serializer_class = KeysetPaginationSerializer
+    cursor_key = 'pk'
+    cursor_query_param = 'cursor'
+
+    def paginate_queryset(self, queryset):
+        page_size = self.get_paginate_by()
+        if not page_size:
+            return None
+
+        queryset = queryset.order_by(self.cursor_key)
+        cursor = self.request.query_params.get(self.cursor_query_param)
+        if cursor:
+            queryset = queryset.filter(
+                **{self.cursor_key + '__gt': decode_cursor(cursor)})
+
+        # Fetch one more to know whether there is a next page
+        object_list = list(queryset[:page_size + 1])
+        if len(object_list) <= page_size:
+            return KeysetPage(object_list)
+        object_list = object_list[:page_size]
+        return KeysetPage(object_list, encode_cursor(
+            object_list[-1].serializable_value(self.cursor_key)))
@@ -1,10 +1,23 @@
 import json
+import time
+from collections import defaultdict
+from itertools import izip
+
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.db import transaction
 from rest_framework import serializers
+from rest_framework.fields import empty
 from models import (Article, Topic, Question, Answer,
                     HighlightGroup, MCSubmittedAnswer,
                     DTSubmittedAnswer, CLSubmittedAnswer,
-                    TBSubmittedAnswer, Client, ArticleHighlight)
+                    TBSubmittedAnswer, Client, ArticleHighlight,
+                    UserProfile, SubmittedAnswerEvent, AgreementScore,
+                    TaskLease,
+                    SUBMITTED_ANSWER_MODELS, prefetch_submitted_answers,
+                    update_user_counters)
+from bulk import reserve_ids
+from metrics import add_serializer_time
 
 
 # Custom JSON field
@@ -23,15 +36,180 @@ class JSONSerializerField(serializers.Field):
         return json.dumps(data)
 
 
+# Sparse fieldsets
+def parse_field_paths(value):
+    """
+    Parses a comma separated list of field names, where fields of nested
+    serializers are dotted paths (e.g. "article.text"), into a tree of dicts.
+    """
+    tree = {}
+    for path in value.split(','):
+        node = tree
+        for name in path.strip().split('.'):
+            if name:
+                node = node.setdefault(name, {})
+    return tree
+
+def nested_serializer(field):
+    """
+    Returns the serializer that field nests, or None if it isn't one.
+    """
+    if isinstance(field, serializers.ListSerializer):
+        field = field.child
+    if isinstance(field, serializers.Serializer):
+        return field
+    return None
+
+def find_nested(serializer, *path):
+    """
+    Returns the serializer nested in serializer at path (field names), or None
+    if one of the fields isn't there.
+    """
+    for name in path:
+        if serializer is None or name not in serializer.fields.keys():
+            return None
+        serializer = nested_serializer(serializer.fields[name])
+    return serializer
+
+def prune_fields(serializer, include, exclude):
+    """
+    Removes the fields not in include (if it isn't empty) and the fields in
+    exclude from serializer and the serializers it nests.
+    """
+    fields = serializer.fields
+    for name in list(fields.keys()):
+        if (include and name not in include) or exclude.get(name) == {}:
+            del fields[name]
+    for name, field in fields.items():
+        nested = nested_serializer(field)
+        if nested is not None and (include.get(name) or exclude.get(name)):
+            prune_fields(nested, include.get(name, {}), exclude.get(name, {}))
+
+def unused_columns(serializer):
+    """
+    Returns the columns of the serializer's model that none of its fields
+    read, to be left out of the query with QuerySet.defer().
+    """
+    sources = set()
+    for field in serializer.fields.values():
+        if not field.source_attrs:
+            # The field reads the whole object
+            return []
+        sources.add(field.source_attrs[0])
+    return [field.name for field in serializer.Meta.model._meta.concrete_fields
+            if not field.primary_key and not field.rel
+            and field.name not in sources]
+
+class SparseFieldsMixin(object):
+    """
+    Lets GET requests pick the fields of the response with ?fields= and
+    ?exclude=, comma separated lists of field names. Fields of nested
+    serializers are dotted paths, e.g. ?exclude=article.text.
+    Also reports the time spent serializing to the request metrics.
+    """
+    @property
+    def fields(self):
+        fields = super(SparseFieldsMixin, self).fields
+        if not getattr(self, '_fields_pruned', False):
+            self._fields_pruned = True
+            request = self.context.get('request')
+            if (request is not None and request.method == 'GET'
+                    and self.is_outermost()):
+                params = getattr(request, 'query_params', request.GET)
+                prune_fields(self, parse_field_paths(params.get('fields', '')),
+                             parse_field_paths(params.get('exclude', '')))
+        return fields
+
+    def to_representation(self, instance):
+        # Time the outermost serializers only, nested ones are part of them
+        if not self.is_outermost():
+            return super(SparseFieldsMixin, self).to_representation(instance)
+        start = time.time()
+        try:
+            return super(SparseFieldsMixin, self).to_representation(instance)
+        finally:
+            add_serializer_time(time.time() - start)
+
+    def is_outermost(self):
+        # Nested serializers are pruned by the outermost one
+        parent = self.parent
+        while parent is not None:
+            if isinstance(parent, SparseFieldsMixin):
+                return False
+            parent = parent.parent
+        return True
+
+
+# Related instances loaded in bulk
+def load_submitted_instances(submissions, context):
+    """
+    Fetches the questions, answers and user profiles that the submitted
+    answers of highlight group submissions refer to, with one query per
+    model, and stores them by id in context['instances'].
+    """
+    ids = {Question: set(), Answer: set(), UserProfile: set()}
+    def add_ids(model, values):
+        # Anything else is left for the fields to reject
+        for value in values:
+            if isinstance(value, (int, long, basestring)):
+                try:
+                    ids[model].add(int(value))
+                except ValueError:
+                    pass
+
+    for submission in submissions:
+        if not isinstance(submission, dict):
+            continue
+        answers = submission.get('questions')
+        if not isinstance(answers, list):
+            continue
+        for answer in answers:
+            if not isinstance(answer, dict):
+                continue
+            add_ids(Question, [answer.get('question')])
+            add_ids(UserProfile, [answer.get('user')])
+            # Checklist answers are a list of ids. Text and date answers
+            # that happen to look like ids are fetched for nothing.
+            value = answer.get('answer')
+            add_ids(Answer, value if isinstance(value, list) else [value])
+
+    context['instances'] = dict((model, model.objects.in_bulk(list(pks)))
+                                for model, pks in ids.items())
+
+def cached_instance(context, model, pk):
+    """
+    Returns the instance of model with pk from context['instances'], or None
+    if it wasn't loaded.
+    """
+    instances = context.get('instances', {}).get(model)
+    if instances is None:
+        return None
+    try:
+        return instances.get(int(pk))
+    except (TypeError, ValueError):
+        return None
+
+class CachedPrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
+    """
+    A PrimaryKeyRelatedField that uses the instances loaded by
+    load_submitted_instances and only queries for ids that weren't loaded
+    """
+    def to_internal_value(self, data):
+        instance = cached_instance(self.context, self.queryset.model, data)
+        if instance is not None:
+            return instance
+        return super(CachedPrimaryKeyRelatedField, self).to_internal_value(data)
+
+
 # Serializers define the API representation of the models.
 
-class ClientSerializer(serializers.ModelSerializer):
+class ClientSerializer(SparseFieldsMixin, serializers.ModelSerializer):
 
     class Meta:
         model = Client
         fields = ('name', 'topic')
 
-class ArticleSerializer(serializers.ModelSerializer):
+class ArticleSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     annotators = JSONSerializerField()
 
     class Meta:
@@ -40,13 +218,13 @@ class ArticleSerializer(serializers.ModelSerializer):
                   'state_published', 'periodical', 'periodical_code',
                   'parse_version', 'annotators')
 
-class AnswerSerializer(serializers.ModelSerializer):
+class AnswerSerializer(SparseFieldsMixin, serializers.ModelSerializer):
 
     class Meta:
         model = Answer
         fields = ('id', 'answer_id', 'answer_content', 'next_question')
 
-class QuestionSerializer(serializers.ModelSerializer):
+class QuestionSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     # A nested serializer for all the answers (if any)
     answers = AnswerSerializer(many=True)
 
@@ -54,7 +232,7 @@ class QuestionSerializer(serializers.ModelSerializer):
         model = Question
         fields = ('id', 'question_id', 'type', 'question_text', 'answers')
 
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     password = serializers.Field(write_only=True)
     experience_score = serializers.DecimalField(max_digits=5, decimal_places=3)
     accuracy_score = serializers.DecimalField(max_digits=5, decimal_places=3)
@@ -84,39 +262,66 @@ class UserSerializer(serializers.ModelSerializer):
                   'experience_score', 'accuracy_score')
 
 class MCSubmittedAnswerSerializer(serializers.ModelSerializer):
-    question = serializers.PrimaryKeyRelatedField(queryset=Question.objects.all())
-    answer = serializers.PrimaryKeyRelatedField(queryset=Answer.objects.all()) 
-    user = UserSerializer()
+    question = CachedPrimaryKeyRelatedField(queryset=Question.objects.all())
+    answer = CachedPrimaryKeyRelatedField(queryset=Answer.objects.all()) 
+    user = CachedPrimaryKeyRelatedField(source='user_submitted',
+                                        queryset=UserProfile.objects.all())
 
     class Meta:
         model = MCSubmittedAnswer
         fields = ('question', 'answer', 'user')
 
 class CLSubmittedAnswerSerializer(serializers.ModelSerializer):
-    question = serializers.PrimaryKeyRelatedField(queryset=Question.objects.all())
-    answer = serializers.PrimaryKeyRelatedField(many=True, queryset=Answer.objects.all())
-    user = UserSerializer()
+    question = CachedPrimaryKeyRelatedField(queryset=Question.objects.all())
+    answer = CachedPrimaryKeyRelatedField(many=True, queryset=Answer.objects.all())
+    user = CachedPrimaryKeyRelatedField(source='user_submitted',
+                                        queryset=UserProfile.objects.all())
 
     class Meta:
          model = CLSubmittedAnswer
          fields = ('question', 'answer', 'user')
  
 class TBSubmittedAnswerSerializer(serializers.ModelSerializer):
-    question = serializers.PrimaryKeyRelatedField(queryset=Question.objects.all())
-    user = UserSerializer()
+    question = CachedPrimaryKeyRelatedField(queryset=Question.objects.all())
+    user = CachedPrimaryKeyRelatedField(source='user_submitted',
+                                        queryset=UserProfile.objects.all())
 
     class Meta:
          model = TBSubmittedAnswer
          fields = ('question', 'answer', 'user')
    
 class DTSubmittedAnswerSerializer(serializers.ModelSerializer):
-    question = serializers.PrimaryKeyRelatedField(queryset=Question.objects.all())
-    user = UserSerializer()
+    question = CachedPrimaryKeyRelatedField(queryset=Question.objects.all())
+    user = CachedPrimaryKeyRelatedField(source='user_submitted',
+                                        queryset=UserProfile.objects.all())
 
     class Meta:
          model = DTSubmittedAnswer
          fields = ('question', 'answer', 'user')
 
+class SubmittedAnswerValueField(serializers.Field):
+    """
+    The answer of a SubmittedAnswerEvent, represented like the answer field of
+    the serializer of its type.
+    """
+    value_fields = {"dt": serializers.DateTimeField()}
+
+    def to_representation(self, event):
+        field = self.value_fields.get(event.type)
+        if field is None:
+            return event.value
+        return field.to_representation(event.value)
+
+class SubmittedAnswerEventSerializer(serializers.ModelSerializer):
+    question = serializers.PrimaryKeyRelatedField(read_only=True)
+    answer = SubmittedAnswerValueField(source='*', read_only=True)
+    user = serializers.PrimaryKeyRelatedField(source='user_submitted',
+                                              read_only=True)
+
+    class Meta:
+        model = SubmittedAnswerEvent
+        fields = ('question', 'answer', 'user')
+
 ## Custom fields for the serializers ##
 
 class GenericSubmittedAnswerField(serializers.Field):
@@ -134,6 +339,9 @@ class GenericSubmittedAnswerField(serializers.Field):
                    "dt" : DTSubmittedAnswerSerializer}
 
     def to_representation(self, obj):
+        if isinstance(obj, SubmittedAnswerEvent):
+            return SubmittedAnswerEventSerializer(obj).data
+
         question_type = obj.question.type
         serializer = self.serializers[question_type]
 
@@ -141,19 +349,22 @@ class GenericSubmittedAnswerField(serializers.Field):
 
     def to_internal_value(self, data):
         question_id = data.get('question', None)
-        try:
-            question = Question.objects.get(id=question_id)
-        except:
-            raise serializers.ValidationError('Invalid Question ID')
+        question = cached_instance(self.context, Question, question_id)
+        if question is None:
+            try:
+                question = Question.objects.get(id=question_id)
+            except:
+                raise serializers.ValidationError('Invalid Question ID')
 
         serializer = self.serializers[question.type]
-        serialized_instance = serializer(data=data)
+        serialized_instance = serializer(data=data, context=self.context)
         if not serialized_instance.is_valid():
             raise serializers.ValidationError(serialized_instance.errors)
         deserialized_data = serialized_instance.validated_data
         model = self.models[question.type]
 
-        return {'class':model, 'data':deserialized_data} 
+        return {'class':model, 'type':question.type,
+                'data':deserialized_data} 
                                
 
 # A serializer for a highlight group
@@ -216,7 +427,94 @@ class OffsetField(serializers.Field):
         ret = json.loads(data) # Convert to Python dict
         return json.dumps(ret["offsets"]) # Convert back to native form of offsets, a JSON object
 
-class HighlightGroupSerializer(serializers.Serializer):
+def create_submitted_answers(answers):
+    """
+    Inserts (highlight_group, submitted answer) pairs, one bulk insert per
+    table.
+    """
+    if settings.CONSOLIDATED_ANSWERS:
+        events = []
+        for highlight_group, answer in answers:
+            kwargs = dict(answer['data'])
+            events.append(SubmittedAnswerEvent.build(
+                answer['type'], kwargs.pop('answer'),
+                highlight_group=highlight_group, **kwargs))
+        SubmittedAnswerEvent.objects.bulk_create(events)
+        return
+
+    instances = dict((model, []) for model in SUBMITTED_ANSWER_MODELS)
+    checklist_answers = []
+    for highlight_group, answer in answers:
+        model = answer['class']
+        kwargs = dict(answer['data'])
+        kwargs['highlight_group'] = highlight_group
+        # A checklist answer's choices go in the many to many table,
+        # which needs the answer's id
+        if model == CLSubmittedAnswer:
+            checklist_answers.append(kwargs.pop('answer'))
+        instances[model].append(model(**kwargs))
+
+    checklists = instances[CLSubmittedAnswer]
+    for checklist_id, checklist in izip(
+            reserve_ids(CLSubmittedAnswer, len(checklists)), checklists):
+        checklist.id = checklist_id
+    for model, model_instances in instances.items():
+        if model_instances:
+            model.objects.bulk_create(model_instances)
+
+    Choice = CLSubmittedAnswer.answer.through
+    Choice.objects.bulk_create([
+        Choice(clsubmittedanswer_id=checklist.id, answer_id=choice.pk)
+        for checklist, choices in izip(checklists, checklist_answers)
+        for choice in choices
+    ])
+
+def create_highlight_groups(submissions):
+    """
+    Creates the highlight groups and submitted answers of a list of
+    validated submissions in one transaction, with one bulk insert per table.
+    """
+    with transaction.atomic():
+        group_ids = reserve_ids(HighlightGroup, len(submissions))
+        highlight_groups = []
+        answers = []
+        for group_id, validated_data in izip(group_ids, submissions):
+            # Get the answers nested models
+            submitted_answers = validated_data.pop('questions')
+
+            # Remove the force_insert if it's there
+            validated_data.pop('force_insert', None)
+
+            highlight_group = HighlightGroup(id=group_id, **validated_data)
+            highlight_groups.append(highlight_group)
+            answers.extend((highlight_group, answer)
+                           for answer in submitted_answers)
+
+        HighlightGroup.objects.bulk_create(highlight_groups)
+        create_submitted_answers(answers)
+
+        submitted = defaultdict(int)
+        for _, answer in answers:
+            submitted[answer['data']['user_submitted'].pk] += 1
+        update_user_counters(dict(
+            (user, {'answers_submitted': count})
+            for user, count in submitted.items()))
+
+    # Attach the answers for serializing the response
+    prefetch_submitted_answers(highlight_groups)
+    return highlight_groups
+
+class HighlightGroupListSerializer(serializers.ListSerializer):
+    def to_internal_value(self, data):
+        # Load what every submission in the list refers to at once
+        if isinstance(data, list):
+            load_submitted_instances(data, self.context)
+        return super(HighlightGroupListSerializer, self).to_internal_value(data)
+
+    def create(self, validated_data):
+        return create_highlight_groups(validated_data)
+
+class HighlightGroupSerializer(SparseFieldsMixin, serializers.Serializer):
     # W3 Annotation Data Model properties
 #    def __init__(self, offsets=[], **kwargs):
 #        serializers.Serializer.__init__(self, **kwargs)
@@ -230,48 +528,25 @@ class HighlightGroupSerializer(serializers.Serializer):
     class Meta:
         model = HighlightGroup
         fields = ('offsets', 'questions')
+        list_serializer_class = HighlightGroupListSerializer
 
-    def create(self, validated_data):
-        # Get the answers nested models
-        answers = validated_data.pop('questions')
-
-        # Remove the force_insert if it's there
-        validated_data.pop('force_insert', None)
+    def run_validation(self, data=empty):
+        # With many=True the list serializer has loaded them already
+        if 'instances' not in self.context and isinstance(data, dict):
+            load_submitted_instances([data], self.context)
+        return super(HighlightGroupSerializer, self).run_validation(data)
 
-        # create the highlight group first
-        highlight_group = HighlightGroup.objects.create(**validated_data)
+    def create(self, validated_data):
+        return create_highlight_groups([validated_data])[0]
 
-        # Add the highlight group model to the kwargs and save
-        for answer in answers:
-            model = answer['class']
-            kwargs = answer['data']
-            # Add the highlight group instance to the kwargs
-            kwargs['highlight_group'] = highlight_group
-
-            # There is a special case if it's a checklist,
-            # Because of the many to many relationship, this needs to be saved differently
-            if model == CLSubmittedAnswer:
-                # Get the answers:
-                answers = kwargs.pop('answer')
-                # first create the CLSubmitted answer
-                submission = CLSubmittedAnswer.objects.create(**kwargs)
-                # Now add the answers
-                submission.answer.add(*answers)
-
-            # For all other models, simply create the objects
-            else:
-                model.objects.create(**kwargs)
-
-        return highlight_group
-
-class ArticleHighlightSerializer(serializers.ModelSerializer):
+class ArticleHighlightSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     article = ArticleSerializer()
     highlight = HighlightGroupSerializer()
     class Meta:
         model = ArticleHighlight
         fields = ('article', 'highlight')
 
-class TopicSerializer(serializers.ModelSerializer):
+class TopicSerializer(SparseFieldsMixin, serializers.ModelSerializer):
         # A nested serializer for all the questions
     related_questions = QuestionSerializer(many=True)
 
@@ -285,7 +560,29 @@ class TopicSerializer(serializers.ModelSerializer):
                   'order', 'glossary', 'instructions', 
                   'related_questions', 'article_highlight')
 
-class RootTopicSerializer(serializers.ModelSerializer):
+class TopicTreeSerializer(TopicSerializer):
+    # A schema is one level deep: an analysis type and its topics
+    subtopics = TopicSerializer(many=True)
+
+    class Meta(TopicSerializer.Meta):
+        fields = TopicSerializer.Meta.fields + ('subtopics',)
+
+class AgreementScoreSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    class Meta:
+        model = AgreementScore
+        fields = ('article', 'topic', 'coders', 'overlap', 'highlight_alpha',
+                  'answer_alpha', 'computed_at')
+
+class TaskLeaseSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    article_highlight = ArticleHighlightSerializer(
+        source='unit.article_highlight')
+
+    class Meta:
+        model = TaskLease
+        fields = ('id', 'user', 'leased_at', 'expires_at', 'completed_at',
+                  'article_highlight')
+
+class RootTopicSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     glossary = JSONSerializerField()
 
     class Meta:
@@ -0,0 +1,122 @@
+# Hands out article highlights to annotators as units of work.
+#
+# An annotator leases the next unit of a topic that fewer than
+# TASK_REDUNDANCY annotators have completed or currently hold, and that the
+# annotator hasn't already done. On PostgreSQL the unit row is locked with
+# FOR UPDATE SKIP LOCKED, so concurrent annotators each skip the units the
+# others are leasing instead of waiting on them or leasing the same one.
+# The locking query reads the leases as they were when it started, so once
+# the lock is held the unit is checked again against the leases committed
+# since. A lease that isn't completed by its expiry stops counting, the unit
+# goes back to the queue, and the lease can no longer be completed.
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from models import TaskLease, WorkUnit
+
+class LeaseExpired(Exception):
+    pass
+
+def next_unit(topic_id, user_id, now, exclude=()):
+    """
+    Returns the id of the next work unit of topic_id user_id can lease, other
+    than those in exclude, locked for the transaction on PostgreSQL, or None
+    if there is none.
+    """
+    qn = connection.ops.quote_name
+    sql = """
+        SELECT u.{unit_pk} FROM {units} u
+        WHERE u.{topic} = %s AND u.{completed} < %s
+          AND (SELECT COUNT(*) FROM {leases} l
+               WHERE l.{unit} = u.{unit_pk}
+                 AND (l.{completed_at} IS NOT NULL OR l.{expires_at} > %s)) < %s
+          AND NOT EXISTS (SELECT 1 FROM {leases} l
+                          WHERE l.{unit} = u.{unit_pk} AND l.{user} = %s
+                            AND (l.{completed_at} IS NOT NULL
+                                 OR l.{expires_at} > %s))
+          {exclude}
+        ORDER BY u.{completed}, u.{unit_pk}
+        LIMIT 1
+    """.format(units=qn(WorkUnit._meta.db_table),
+               leases=qn(TaskLease._meta.db_table),
+               unit_pk=qn(WorkUnit._meta.pk.column), topic=qn('topic_id'),
+               completed=qn('completed'), unit=qn('unit_id'),
+               user=qn('user_id'), completed_at=qn('completed_at'),
+               expires_at=qn('expires_at'),
+               exclude='AND u.{0} NOT IN ({1})'.format(
+                   qn(WorkUnit._meta.pk.column),
+                   ', '.join(['%s'] * len(exclude))) if exclude else '')
+    if connection.vendor == 'postgresql':
+        sql += " FOR UPDATE OF u SKIP LOCKED"
+    now = connection.ops.value_to_db_datetime(now)
+    redundancy = settings.TASK_REDUNDANCY
+    cursor = connection.cursor()
+    cursor.execute(sql, [topic_id, redundancy, now, redundancy, user_id, now]
+                   + list(exclude))
+    row = cursor.fetchone()
+    return row and row[0]
+
+def can_lease(unit_id, user_id, now):
+    """
+    Returns whether user_id can lease the work unit unit_id, by the leases
+    committed when called.
+    """
+    leases = TaskLease.objects.filter(unit=unit_id) \
+                              .exclude(completed_at=None, expires_at__lte=now)
+    return (WorkUnit.objects.filter(pk=unit_id,
+                                    completed__lt=settings.TASK_REDUNDANCY)
+                            .exists()
+            and leases.count() < settings.TASK_REDUNDANCY
+            and not leases.filter(user=user_id).exists())
+
+def lease_next(topic_id, user_id):
+    """
+    Returns the lease of the next work unit of topic_id for user_id: the
+    unit the user already holds, if any, or a newly leased one. Returns None
+    when the topic has no unit left for the user.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        leases = TaskLease.objects.filter(user=user_id, unit__topic=topic_id,
+                                          completed_at=None,
+                                          expires_at__gt=now)
+        lease = leases.order_by('expires_at').first()
+        if lease is not None:
+            return lease
+
+        # Every leasing transaction holds the unit's lock, so no lease of the
+        # unit can be committed between the check and the new lease
+        skipped = []
+        unit_id = next_unit(topic_id, user_id, now)
+        while unit_id is not None and not can_lease(unit_id, user_id, now):
+            skipped.append(unit_id)
+            unit_id = next_unit(topic_id, user_id, now, skipped)
+        if unit_id is None:
+            return None
+        return TaskLease.objects.create(
+            unit_id=unit_id, user_id=user_id, expires_at=now + timedelta(
+                seconds=settings.TASK_LEASE_SECONDS))
+
+def complete(lease):
+    """
+    Marks lease completed and counts it on its work unit. Completing a lease
+    twice counts it once. Raises LeaseExpired if the lease expired before it
+    was completed, when the unit may have been leased to someone else.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        completed = TaskLease.objects.filter(pk=lease.pk, completed_at=None,
+                                             expires_at__gt=now) \
+                                     .update(completed_at=now)
+        if completed:
+            WorkUnit.objects.filter(pk=lease.unit_id) \
+                            .update(completed=F('completed') + 1)
+    lease = TaskLease.objects.get(pk=lease.pk)
+    if lease.completed_at is None:
+        raise LeaseExpired
+    return lease
@@ -1,3 +1,323 @@
-from django.test import TestCase
+import json
+import os
+import tempfile
+from datetime import timedelta
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from data.duplicates import NearDuplicateIndex, signature
+from data.parse_document import parse_document, read_jsonl, write_jsonl
+from thresher import flow, tasks
+from thresher.agreement import update_agreement
+from thresher.caching import SCHEMA, get_version
+from thresher.models import (AgreementScore, Answer, Article,
+                             ArticleHighlight, HighlightGroup, HighlightSpan,
+                             MCSubmittedAnswer, Question, TaskLease, Topic,
+                             UserCounters, UserProfile, WorkUnit,
+                             highlight_overlaps, update_user_counters)
+
+def create_user(username):
+    user = User.objects.create_user(username)
+    return UserProfile.objects.create(user=user, experience_score=0,
+                                      accuracy_score=0)
+
+def create_highlight(article, topic, offsets):
+    highlight = HighlightGroup.objects.create(offsets=json.dumps(offsets))
+    ArticleHighlight.objects.create(article=article, topic=topic,
+                                    highlight=highlight)
+    HighlightSpan.objects.bulk_create(HighlightSpan.from_offsets(
+        offsets, highlight_group=highlight, article=article, topic=topic))
+    return highlight
+
+class AgreementTests(TestCase):
+    def setUp(self):
+        self.article = Article.objects.create(
+            article_id=1, text='x' * 100, city_published='Albany',
+            periodical='Herald', periodical_code=1,
+            annotators=json.dumps(['SLG']))
+        self.topic = Topic.objects.create(name='Protester', instructions='',
+                                          glossary='{}')
+        subtopic = Topic.objects.create(name='Event', parent=self.topic,
+                                        order=1, instructions='',
+                                        glossary='{}')
+        self.question = Question.objects.create(
+            question_id=1, topic=subtopic, type='mc', question_text='Type?',
+            contingency=False)
+        self.answers = [Answer.objects.create(question=self.question,
+                                              answer_id=i,
+                                              answer_content='Answer %d' % i)
+                        for i in (1, 2)]
+
+    def answer(self, highlight, user, answer):
+        MCSubmittedAnswer.objects.create(highlight_group=highlight,
+                                         question=self.question,
+                                         answer=answer, user_submitted=user)
+
+    def score(self):
+        update_agreement([self.article.article_id])
+        return AgreementScore.objects.get(article=self.article,
+                                          topic=self.topic)
+
+    def test_users_with_different_spans(self):
+        first = create_highlight(self.article, self.topic, [[0, 50]])
+        second = create_highlight(self.article, self.topic, [[25, 75]])
+        self.answer(first, create_user('first'), self.answers[0])
+        self.answer(second, create_user('second'), self.answers[1])
+
+        score = self.score()
+        self.assertEqual(score.coders, 2)
+        self.assertAlmostEqual(score.overlap, 25 / 75.0)
+        self.assertIsNotNone(score.highlight_alpha)
+        self.assertLess(score.highlight_alpha, 1)
+
+    def test_user_and_loaded_annotation(self):
+        create_highlight(self.article, self.topic, [[0, 50]])
+        answered = create_highlight(self.article, self.topic, [[0, 50]])
+        self.answer(answered, create_user('user'), self.answers[0])
+
+        score = self.score()
+        self.assertEqual(score.coders, 2)
+        self.assertEqual(score.overlap, 1)
+        self.assertAlmostEqual(score.highlight_alpha, 1)
+
+    def test_new_answer_to_a_scored_highlight(self):
+        highlight = create_highlight(self.article, self.topic, [[10, 20]])
+        for username in ('a', 'b'):
+            self.answer(highlight, create_user(username), self.answers[0])
+        self.assertEqual(self.score().coders, 2)
+        self.assertEqual(update_agreement([self.article.article_id]), 0)
+
+        self.answer(highlight, create_user('c'), self.answers[1])
+        response = self.client.post('/api/articles/1/agreement')
+        self.assertEqual(json.loads(response.content)[0]['coders'], 3)
+        self.assertEqual(update_agreement([self.article.article_id]), 0)
+
+    def test_users_answering_the_same_highlight(self):
+        highlight = create_highlight(self.article, self.topic, [[10, 20]])
+        for username in ('a', 'b', 'c'):
+            self.answer(highlight, create_user(username), self.answers[0])
+
+        score = self.score()
+        self.assertEqual(score.coders, 3)
+        self.assertEqual(score.overlap, 1)
+        self.assertEqual(score.answer_alpha, None)
+
+class UserCountersTests(TestCase):
+    def test_first_and_later_submissions(self):
+        profile = create_user('user')
+        update_user_counters({profile.pk: {'answers_submitted': 2}})
+        update_user_counters({profile.pk: {'answers_submitted': 3,
+                                           'answers_checked': 1}})
+
+        counters = UserCounters.objects.get(profile=profile)
+        self.assertEqual(counters.answers_submitted, 5)
+        self.assertEqual(counters.answers_checked, 1)
+        profile = UserProfile.objects.get(pk=profile.pk)
+        self.assertEqual((profile.experience_score, profile.accuracy_score),
+                         counters.scores())
+
+@override_settings(TASK_REDUNDANCY=2)
+class TaskTests(TestCase):
+    def setUp(self):
+        article = Article.objects.create(
+            article_id=1, text='x' * 100, city_published='Albany',
+            periodical='Herald', periodical_code=1, annotators='[]')
+        self.topic = Topic.objects.create(name='Protester', instructions='',
+                                          glossary='{}')
+        self.units = []
+        for offsets in ([[0, 10]], [[20, 30]]):
+            create_highlight(article, self.topic, offsets)
+            self.units.append(WorkUnit.objects.create(
+                article_highlight=ArticleHighlight.objects.latest('pk'),
+                topic=self.topic))
+        self.users = [create_user(username) for username in 'abc']
+
+    def lease(self, user):
+        return tasks.lease_next(self.topic.pk, user.pk)
+
+    def test_user_keeps_the_unit_leased(self):
+        lease = self.lease(self.users[0])
+        self.assertEqual(self.lease(self.users[0]), lease)
+
+    def test_unit_goes_to_redundancy_annotators(self):
+        first, second, third = [self.lease(user) for user in self.users]
+        self.assertEqual(first.unit, self.units[0])
+        self.assertEqual(second.unit, self.units[0])
+        self.assertEqual(third.unit, self.units[1])
+
+    def test_user_does_not_get_a_completed_unit_again(self):
+        tasks.complete(self.lease(self.users[0]))
+        self.assertEqual(self.lease(self.users[0]).unit, self.units[1])
+        self.assertEqual(WorkUnit.objects.get(pk=self.units[0].pk).completed,
+                         1)
+
+    def test_next_unit_skips_excluded_units(self):
+        now = timezone.now()
+        user = self.users[0].pk
+        self.assertEqual(tasks.next_unit(self.topic.pk, user, now,
+                                         [self.units[0].pk]),
+                         self.units[1].pk)
+        self.assertTrue(tasks.can_lease(self.units[0].pk, user, now))
+        self.lease(self.users[0])
+        self.assertFalse(tasks.can_lease(self.units[0].pk, user, now))
+
+    def test_nothing_left(self):
+        for unit in self.units:
+            WorkUnit.objects.filter(pk=unit.pk).update(completed=2)
+        self.assertIsNone(self.lease(self.users[0]))
+
+    def test_expired_lease_frees_the_unit(self):
+        expired = self.lease(self.users[0])
+        self.lease(self.users[1])
+        TaskLease.objects.filter(pk=expired.pk).update(
+            expires_at=timezone.now() - timedelta(seconds=1))
+
+        self.assertEqual(self.lease(self.users[2]).unit, self.units[0])
+        self.assertRaises(tasks.LeaseExpired, tasks.complete, expired)
+        self.assertEqual(WorkUnit.objects.get(pk=self.units[0].pk).completed,
+                         0)
+
+    def complete(self, lease, user):
+        return self.client.post('/api/leases/%d/complete' % lease.pk,
+                                json.dumps({'user': user.pk}),
+                                content_type='application/json')
+
+    def test_complete_view(self):
+        lease = self.lease(self.users[0])
+        self.assertEqual(self.complete(lease, self.users[1]).status_code, 403)
+        self.assertEqual(self.complete(lease, self.users[0]).status_code, 200)
+
+        TaskLease.objects.filter(pk=lease.pk).update(
+            completed_at=None, expires_at=timezone.now())
+        self.assertEqual(self.complete(lease, self.users[0]).status_code, 409)
+
+class HighlightGroupTests(TestCase):
+    def setUp(self):
+        topic = Topic.objects.create(name='Protester', instructions='',
+                                     glossary='{}')
+        self.question = Question.objects.create(
+            question_id=1, topic=topic, type='mc', question_text='Type?',
+            contingency=False)
+        self.answer = Answer.objects.create(question=self.question,
+                                            answer_id=1,
+                                            answer_content='Answer 1')
+        self.user = create_user('user')
+
+    def post(self, **answer):
+        data = dict({'question': self.question.pk, 'user': self.user.pk,
+                     'answer': self.answer.pk}, **answer)
+        return self.client.post('/api/highlight_groups/', json.dumps({
+            'offsets': [[0, 10]], 'questions': [data]}),
+            content_type='application/json')
+
+    def test_submission(self):
+        self.assertEqual(self.post().status_code, 201)
+        self.assertEqual(MCSubmittedAnswer.objects.count(), 1)
+
+    def test_malformed_ids(self):
+        for answer in ({'question': [self.question.pk]},
+                       {'user': {'id': self.user.pk}},
+                       {'answer': {'x': 1}}):
+            self.assertEqual(self.post(**answer).status_code, 400)
+        self.assertEqual(MCSubmittedAnswer.objects.count(), 0)
+
+class SchemaCacheTests(TestCase):
+    def setUp(self):
+        self.topic = Topic.objects.create(name='Protester', instructions='',
+                                          glossary='{}')
+
+    def create_question(self, question_id):
+        return Question.objects.create(
+            question_id=question_id, topic=self.topic, type='mc',
+            question_text='Question %d?' % question_id, contingency=False)
+
+    def test_edits_bump_the_schema_version(self):
+        version = get_version(SCHEMA)
+        question = self.create_question(1)
+        self.assertNotEqual(get_version(SCHEMA), version)
+
+        version = get_version(SCHEMA)
+        answer = Answer.objects.create(question=question, answer_id=1,
+                                       answer_content='Answer 1')
+        self.assertNotEqual(get_version(SCHEMA), version)
+
+        version = get_version(SCHEMA)
+        answer.delete()
+        self.assertNotEqual(get_version(SCHEMA), version)
+
+    def test_flow_serves_new_questions(self):
+        self.create_question(1)
+        flow.get_graph()
+        question = self.create_question(2)
+        # As once the version check interval has passed
+        flow._checked = 0
+        response = self.client.get('/api/question/%d' % question.pk)
+        self.assertEqual(response.status_code, 200)
+
+class OverlapTests(TestCase):
+    def setUp(self):
+        self.article = Article.objects.create(
+            article_id=1, text='x' * 100, city_published='Albany',
+            periodical='Herald', periodical_code=1, annotators='[]')
+        self.topics = [Topic.objects.create(name=name, instructions='',
+                                            glossary='{}')
+                       for name in ('Protester', 'Camp')]
+
+    def test_overlapping_groups(self):
+        first = create_highlight(self.article, self.topics[0],
+                                 [[0, 10], [20, 30]])
+        second = create_highlight(self.article, self.topics[0], [[5, 25]])
+        create_highlight(self.article, self.topics[0], [[50, 60]])
+        create_highlight(self.article, self.topics[1], [[0, 30]])
+
+        self.assertEqual(
+            [tuple(row) for row in highlight_overlaps([1])],
+            [(self.topics[0].pk, first.pk, second.pk, 10)])
+
+    def test_view(self):
+        first = create_highlight(self.article, self.topics[1], [[0, 50]])
+        second = create_highlight(self.article, self.topics[1], [[25, 75]])
+        create_highlight(self.article, self.topics[0], [[0, 50]])
+        create_highlight(self.article, self.topics[0], [[0, 50]])
+
+        response = self.client.get('/api/articles/1/overlaps',
+                                   {'topic': self.topics[1].pk})
+        self.assertEqual(json.loads(response.content), [
+            {'topic': self.topics[1].pk,
+             'highlight_groups': [first.pk, second.pk], 'characters': 25}])
+        response = self.client.get('/api/articles/1/overlaps')
+        self.assertEqual(len(json.loads(response.content)), 2)
+
+class MetricsTests(TestCase):
+    def test_counts_queries_without_keeping_them(self):
+        queries = len(connection.queries)
+        response = self.client.get('/api/articles/1/agreement')
+        self.assertIn('desc="1 queries"', response['Server-Timing'])
+        self.assertEqual(len(connection.queries), queries)
+        self.assertFalse(connection.use_debug_cursor)
+
+    def test_keeps_queries_when_asked(self):
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/articles/1/agreement')
+        self.assertIn('desc="1 queries"', response['Server-Timing'])
+
+class NearDuplicateTests(SimpleTestCase):
+    def test_non_ascii_article_from_jsonl(self):
+        article = parse_document(os.path.join(
+            os.path.dirname(os.path.dirname(__file__)), 'data', 'sample',
+            'article', '0Albany, NY-AlbanyDemocratHerald-01.txt'))
+        self.assertTrue(any(ord(c) > 127 for c in article['text']))
+        with tempfile.NamedTemporaryFile() as f:
+            write_jsonl([article], f)
+            f.flush()
+            text = list(read_jsonl(f.name))[0]['text']
+        self.assertIsInstance(text, unicode)
+        self.assertTrue((signature(text) == signature(article['text'])).all())
+
+        index = NearDuplicateIndex()
+        self.assertIsNone(index.find(1, article['text']))
+        self.assertEqual(index.find(2, text), '1')
@@ -10,6 +10,15 @@ urlpatterns = [
     url(r'^question/(?P<id>[0-9]+)$', views.question),
     url(r'^question/(?P<id>[0-9]+)/(?P<ans_id>[0-9]+)$', views.next_question),
     url(r'^post_question/', views.post_question),
+    url(r'^export/answers$', views.export),
+    url(r'^metrics$', views.metrics),
+    url(r'^articles/(?P<id>[0-9]+)/highlights$',
+        views.article_highlights_in_range),
+    url(r'^articles/(?P<id>[0-9]+)/overlaps$', views.article_overlaps),
+    url(r'^articles/(?P<id>[0-9]+)/agreement$', views.article_agreement),
     url(r'^topics/(?P<id>[0-9]+)/children$', views.child_topics),
     url(r'^topics/(?P<id>[0-9]+)$', views.topic),
+    url(r'^topics/(?P<id>[0-9]+)/tree$', views.topic_tree),
+    url(r'^topics/(?P<id>[0-9]+)/lease$', views.lease_task),
+    url(r'^leases/(?P<id>[0-9]+)/complete$', views.complete_task),
 ]
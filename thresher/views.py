@@ -1,18 +1,74 @@
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.core.paginator import Paginator
+from django.http import Http404, HttpResponse, StreamingHttpResponse
 
 from rest_framework import routers, viewsets
-from rest_framework.decorators import list_route, api_view
+from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from rest_framework import status
+from rest_framework.renderers import JSONRenderer
 
-from models import Article, Topic, HighlightGroup, Client, Question, Answer, ArticleHighlight
+import flow
+import tasks
+from agreement import update_agreement
+from metrics import METRICS
+from export import export_answers
+from caching import SCHEMA, HIGHLIGHTS, bump_version, topic_tree_key
+from pagination import KeysetPaginationMixin
+
+from models import (Article, Topic, HighlightGroup, Client, Question,
+                    ArticleHighlight, AgreementScore, TaskLease,
+                    UserProfile, highlight_overlaps, overlapping_highlights,
+                    prefetch_submitted_answers)
 from serializers import (UserSerializer, ArticleSerializer, TopicSerializer, 
                          HighlightGroupSerializer, ClientSerializer, QuestionSerializer,
-                         ArticleHighlightSerializer, RootTopicSerializer)
+                         ArticleHighlightSerializer, RootTopicSerializer,
+                         TopicTreeSerializer, AgreementScoreSerializer,
+                         TaskLeaseSerializer,
+                         find_nested, unused_columns)
 
 # Views for serving the API
 
+class InvalidatingViewSetMixin(object):
+    """
+    Bumps the cache versions listed in `invalidates` whenever the viewset
+    writes, so cached payloads built from the old rows aren't served again.
+    """
+    invalidates = ()
+
+    def invalidate(self):
+        for name in self.invalidates:
+            bump_version(name)
+
+    def perform_create(self, serializer):
+        super(InvalidatingViewSetMixin, self).perform_create(serializer)
+        self.invalidate()
+
+    def perform_update(self, serializer):
+        super(InvalidatingViewSetMixin, self).perform_update(serializer)
+        self.invalidate()
+
+    def perform_destroy(self, instance):
+        super(InvalidatingViewSetMixin, self).perform_destroy(instance)
+        self.invalidate()
+
+class SubmittedAnswersMixin(object):
+    """
+    Loads the submitted answers of all the highlight groups on a page at
+    once instead of letting each group query for its own.
+    """
+    def get_highlight_groups(self, objects):
+        return objects
+
+    def paginate_queryset(self, queryset):
+        page = super(SubmittedAnswersMixin, self).paginate_queryset(queryset)
+        if page is not None:
+            page.object_list = list(page.object_list)
+            prefetch_submitted_answers(
+                self.get_highlight_groups(page.object_list))
+        return page
+
 class ClientViewSet(viewsets.ModelViewSet):
     queryset = Client.objects.all()
     serializer_class = ClientSerializer    
@@ -21,23 +77,36 @@ class UserViewSet(viewsets.ModelViewSet):
     queryset = User.objects.all()
     serializer_class = UserSerializer
 
-class ArticleViewSet(viewsets.ModelViewSet):
+class ArticleViewSet(KeysetPaginationMixin, InvalidatingViewSetMixin,
+                     viewsets.ModelViewSet):
     queryset = Article.objects.all().order_by('article_id')
     serializer_class = ArticleSerializer
+    invalidates = (HIGHLIGHTS,)
+    paginate_by_param = 'page_size'
+    max_paginate_by = 100
+
+    def get_queryset(self):
+        # Don't read the columns a sparse fieldset leaves out
+        queryset = super(ArticleViewSet, self).get_queryset()
+        return queryset.defer(*unused_columns(self.get_serializer()))
 
-class TopicViewSet(viewsets.ModelViewSet):
+class TopicViewSet(InvalidatingViewSetMixin, viewsets.ModelViewSet):
     queryset = Topic.objects.filter(parent=None)
     serializer_class = RootTopicSerializer
+    invalidates = (SCHEMA,)
 
-class HighlightGroupViewSet(viewsets.ModelViewSet):
+class HighlightGroupViewSet(SubmittedAnswersMixin, InvalidatingViewSetMixin,
+                            viewsets.ModelViewSet):
     queryset = HighlightGroup.objects.all()
     serializer_class = HighlightGroupSerializer
+    invalidates = (HIGHLIGHTS,)
 
     def create(self, request, *args, **kwargs):
         if isinstance(request.DATA, list):
             serializer = HighlightGroupSerializer(data=request.DATA, many=True)
             if serializer.is_valid():
                 self.object = serializer.save(force_insert=True)
+                self.invalidate()
                 return Response(serializer.data, status=status.HTTP_201_CREATED)
             else:
                 return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
@@ -45,9 +114,58 @@ class HighlightGroupViewSet(viewsets.ModelViewSet):
         else:
             return super(HighlightGroupViewSet, self).create(request, *args, **kwargs)
 
-class ArticleHighlightViewSet(viewsets.ModelViewSet):
+class ArticleHighlightViewSet(SubmittedAnswersMixin, KeysetPaginationMixin,
+                              InvalidatingViewSetMixin, viewsets.ModelViewSet):
     queryset = ArticleHighlight.objects.all()
     serializer_class = ArticleHighlightSerializer
+    invalidates = (HIGHLIGHTS,)
+    paginate_by_param = 'page_size'
+    max_paginate_by = 100
+
+    def get_queryset(self):
+        queryset = super(ArticleHighlightViewSet, self).get_queryset()
+        # Only join the articles, and their columns, that the response shows
+        article = find_nested(self.get_serializer(), 'article')
+        if article is None:
+            return queryset.select_related('highlight')
+        return queryset.select_related('article', 'highlight').defer(*[
+            'article__' + column for column in unused_columns(article)])
+
+    def get_highlight_groups(self, objects):
+        return [article_highlight.highlight for article_highlight in objects]
+
+# Everything TopicSerializer reads but the articles, fetched with one query
+# per relation
+TOPIC_PREFETCH = (
+    'related_questions__answers',
+    'article_highlight__highlight',
+)
+
+def load_topic_highlights(topics, serializer, *article_paths):
+    """
+    Attaches the articles and submitted answers of the article highlights of
+    topics. The articles are fetched in one query, without the columns that
+    none of the article serializers at article_paths in serializer read.
+    """
+    article_highlights = [article_highlight
+                          for topic in topics
+                          for article_highlight in topic.article_highlight.all()]
+    prefetch_submitted_answers([article_highlight.highlight
+                                for article_highlight in article_highlights])
+
+    article_serializers = [find_nested(serializer, *path)
+                           for path in article_paths]
+    article_serializers = [article for article in article_serializers
+                           if article is not None]
+    if not article_serializers:
+        return
+    deferred = set.intersection(*[set(unused_columns(article))
+                                  for article in article_serializers])
+    articles = Article.objects.defer(*deferred).in_bulk(list(set(
+        article_highlight.article_id
+        for article_highlight in article_highlights)))
+    for article_highlight in article_highlights:
+        article_highlight.article = articles[article_highlight.article_id]
 
 @api_view(['GET'])
 def topic(request, id):
@@ -56,10 +174,165 @@ def topic(request, id):
     Gets all the information associated with a specific topic.
     """
     if request.method == 'GET':
-        topics = Topic.objects.get(id=id)
-        serializer = TopicSerializer(topics, many=False)
+        topics = Topic.objects.prefetch_related(*TOPIC_PREFETCH).get(id=id)
+        serializer = TopicSerializer(topics, many=False,
+                                     context={'request': request})
+        load_topic_highlights([topics], serializer,
+                              ('article_highlight', 'article'))
+        return Response(serializer.data)
+
+# Everything TopicTreeSerializer reads but the articles, fetched with one
+# query per relation
+TOPIC_TREE_PREFETCH = TOPIC_PREFETCH + tuple(
+    'subtopics__' + lookup for lookup in TOPIC_PREFETCH)
+
+@api_view(['GET'])
+def topic_tree(request, id):
+    """
+    /topics/id/tree \n
+    Gets a topic with its subtopics, their questions and answers and the
+    article highlights of each of them. The serialized JSON is cached until
+    the schema or the highlights change.
+    """
+    if request.method == 'GET':
+        # Each sparse fieldset is cached separately
+        key = topic_tree_key(id, '%s|%s' % (
+            request.query_params.get('fields', ''),
+            request.query_params.get('exclude', '')))
+        content = cache.get(key)
+        if content is None:
+            try:
+                topic = Topic.objects.prefetch_related(*TOPIC_TREE_PREFETCH) \
+                                     .get(id=id)
+            except Topic.DoesNotExist:
+                raise Http404
+            serializer = TopicTreeSerializer(topic, many=False,
+                                             context={'request': request})
+            load_topic_highlights([topic] + list(topic.subtopics.all()),
+                                  serializer,
+                                  ('article_highlight', 'article'),
+                                  ('subtopics', 'article_highlight', 'article'))
+            content = JSONRenderer().render(serializer.data)
+            cache.set(key, content, timeout=None)
+        return HttpResponse(content, content_type='application/json')
+
+@api_view(['GET'])
+def article_highlights_in_range(request, id):
+    """
+    /articles/id/highlights?start=&end=&topic= \n
+    Gets the highlight groups of an article that highlight any character from
+    start up to end (end defaults to start + 1, the highlights covering
+    start), optionally of a single topic.
+    """
+    if request.method == 'GET':
+        try:
+            start = int(request.query_params.get('start', 0))
+            end = int(request.query_params.get('end', start + 1))
+        except ValueError:
+            return Response({'detail': 'start and end must be integers'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        article_highlights = overlapping_highlights(int(id), start, end) \
+            .select_related('highlight').order_by('id')
+        if 'topic' in request.query_params:
+            article_highlights = article_highlights.filter(
+                topic=request.query_params['topic'])
+        highlight_groups = [article_highlight.highlight
+                            for article_highlight in article_highlights]
+        prefetch_submitted_answers(highlight_groups)
+        serializer = HighlightGroupSerializer(highlight_groups, many=True,
+                                              context={'request': request})
         return Response(serializer.data)
 
+@api_view(['GET'])
+def article_overlaps(request, id):
+    """
+    /articles/id/overlaps?topic= \n
+    Gets every pair of highlight groups of the same topic in an article that
+    overlap, with the number of characters they both highlight, optionally
+    of a single topic.
+    """
+    if request.method == 'GET':
+        topic = request.query_params.get('topic')
+        try:
+            topic = int(topic) if topic is not None else None
+        except ValueError:
+            return Response({'detail': 'topic must be an integer'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        return Response([
+            {'topic': topic_id, 'highlight_groups': [first, second],
+             'characters': characters}
+            for topic_id, first, second, characters
+            in highlight_overlaps([int(id)], topic)])
+
+@api_view(['GET', 'POST'])
+def article_agreement(request, id):
+    """
+    /articles/id/agreement?topic= \n
+    Gets the stored agreement between the annotators of an article, per
+    topic. POST computes it first if the article has new highlight groups or
+    submitted answers.
+    """
+    if request.method == 'POST':
+        update_agreement([int(id)])
+    scores = AgreementScore.objects.filter(article=id).order_by('topic')
+    if 'topic' in request.query_params:
+        scores = scores.filter(topic=request.query_params['topic'])
+    serializer = AgreementScoreSerializer(scores, many=True,
+                                          context={'request': request})
+    return Response(serializer.data)
+
+def lease_response(request, lease):
+    """
+    Responds with a lease and its article highlight.
+    """
+    lease = TaskLease.objects.select_related(
+        'unit__article_highlight__article',
+        'unit__article_highlight__highlight').get(pk=lease.pk)
+    prefetch_submitted_answers([lease.unit.article_highlight.highlight])
+    serializer = TaskLeaseSerializer(lease, context={'request': request})
+    return Response(serializer.data)
+
+@api_view(['POST'])
+def lease_task(request, id):
+    """
+    /topics/id/lease \n
+    Leases the next article highlight of a topic to the user in the posted
+    {"user": id}, or returns the one the user already holds. Responds 204 when
+    the topic has nothing left for the user.
+    """
+    if request.method == 'POST':
+        user = request.data.get('user')
+        if not UserProfile.objects.filter(pk=user).exists():
+            return Response({'user': ['Invalid user ID']},
+                            status=status.HTTP_400_BAD_REQUEST)
+        lease = tasks.lease_next(int(id), user)
+        if lease is None:
+            return Response(status=status.HTTP_204_NO_CONTENT)
+        return lease_response(request, lease)
+
+@api_view(['POST'])
+def complete_task(request, id):
+    """
+    /leases/id/complete \n
+    Marks a lease completed by the user it was leased to, posted as
+    {"user": id}. Responds 403 for another user, and 409 when the lease
+    expired before it was completed.
+    """
+    if request.method == 'POST':
+        try:
+            lease = TaskLease.objects.get(pk=id)
+        except TaskLease.DoesNotExist:
+            raise Http404
+        if str(lease.user_id) != str(request.data.get('user')):
+            return Response({'user': ['Not the user the lease is held by']},
+                            status=status.HTTP_403_FORBIDDEN)
+        try:
+            lease = tasks.complete(lease)
+        except tasks.LeaseExpired:
+            return Response({'lease': ['The lease has expired']},
+                            status=status.HTTP_409_CONFLICT)
+        return lease_response(request, lease)
+
 @api_view(['GET'])
 def child_topics(request, id):
     """
@@ -83,7 +356,6 @@ def questions(request):
         serializer = QuestionSerializer(questions, many=True)
         return Response(serializer.data)
 
-@list_route
 @api_view(['GET'])
 def question(request, id):
     """
@@ -91,9 +363,10 @@ def question(request, id):
     Gets a specific question.
     """
     if request.method == 'GET':
-        question = Question.objects.get(id=id)
-        serializer = QuestionSerializer(question, many=False)
-        return Response(serializer.data)
+        question = flow.get_graph().question(int(id))
+        if question is None:
+            raise Http404
+        return Response(question)
 
 @api_view(['GET'])
 def next_question(request, id, ans_id):
@@ -102,13 +375,23 @@ def next_question(request, id, ans_id):
     Gets the next question based on the ans_id
     """
     if request.method == 'GET':
-        question = Question.objects.get(id=id)
-        answer = Answer.objects.get(question=question, answer_id=ans_id)
-        next_question = answer.next_question
-        serializer = QuestionSerializer(next_question, many=False)
-        return Response(serializer.data)
+        next_question = flow.get_graph().next_question(int(id), int(ans_id))
+        if next_question is None:
+            raise Http404
+        return Response(next_question)
 
 
+@api_view(['GET'])
+def export(request):
+    """
+    /export/answers
+    Streams every submitted answer, with its highlight group offsets, article
+    and topic, as JSON lines.
+    """
+    if request.method == 'GET':
+        return StreamingHttpResponse(export_answers(),
+                                     content_type='application/x-ndjson')
+
 # TODO: Post a highlight group.
 @api_view(['POST'])
 def post_question(request):
@@ -120,6 +403,14 @@ def post_question(request):
             return Response(serializer.data)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+def metrics(request):
+    """
+    /metrics \n
+    The request metrics of this process, in the Prometheus text format.
+    """
+    return HttpResponse(METRICS.render(),
+                        content_type='text/plain; version=0.0.4')
+
 # Register our viewsets with the router
 ROUTER = routers.DefaultRouter()
 ROUTER.register(r'clients', ClientViewSet)
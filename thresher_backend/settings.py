@@ -53,6 +53,7 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'thresher.metrics.QueryMetricsMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -83,6 +84,51 @@ DATABASES = {
     }
 }
 
+# Cache
+# https://docs.djangoproject.com/en/1.6/topics/cache/
+# Serialized topic trees are cached in the database so that every web process
+# and load_data.py see the same entries. syncdb creates the table.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'thresher_cache',
+        'OPTIONS': {
+            'MAX_ENTRIES': 1000,
+        },
+    }
+}
+
+# Store submitted answers of every type in the single SubmittedAnswerEvent
+# table instead of one table per type. Copy the existing answers over with
+# `python manage.py consolidate_answers` before turning this on.
+CONSOLIDATED_ANSWERS = False
+
+# The number of annotators each work unit is handed out to, and how long an
+# annotator has to complete a unit before it's handed to someone else
+TASK_REDUNDANCY = 3
+TASK_LEASE_SECONDS = 30 * 60
+
+# Requests over either threshold are logged by QueryMetricsMiddleware
+METRICS_SLOW_QUERIES = 50
+METRICS_SLOW_SECONDS = 1.0
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'thresher': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
+    },
+}
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.6/topics/i18n/
 